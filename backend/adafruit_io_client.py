@@ -1,7 +1,11 @@
 from Adafruit_IO import MQTTClient
+import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
 import os, time
 import base64
+import queue
+import random
+import threading
 # Load .env vars
 load_dotenv()
 
@@ -15,35 +19,378 @@ AIO_FEED_LIGHT = "project-242.light"
 AIO_FEED_IMAGE = "picture"
 AIO_FEED_BUTTON = "project-242.on-off"
 
+# Messaging transport: "adafruit" (Adafruit IO), "mqtt" (a plain MQTT broker at
+# LOCAL_MQTT_BROKER, e.g. on-prem) or "loopback" (in-process, for tests and
+# benchmarks). Feed names are used as topic names on the non-Adafruit ones.
+MESSAGING_TRANSPORT = os.getenv("MESSAGING_TRANSPORT", "adafruit")
+# Local MQTT broker for the binary picture transport (see frame_chunks.py) and
+# the "mqtt" transport; unset keeps the picture feed on Adafruit IO only
+LOCAL_MQTT_BROKER = os.getenv("LOCAL_MQTT_BROKER")
+LOCAL_MQTT_PORT = int(os.getenv("LOCAL_MQTT_PORT", "1883"))
+TOPIC_IMAGE_SIZE = "image/size"
+TOPIC_IMAGE_CHUNKS = "image/chunks"
+# Reconnection backoff in seconds, doubled after every failed attempt
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+CONNECT_TIMEOUT = 10
+HEALTH_CHECK_INTERVAL = 5  # seconds between connection checks when no disconnect was reported
+KEEP_ALIVE = 60
+
+###############################################################################
+# Transports
+###############################################################################
+# A transport is one broker session: connect() opens it (raising on failure)
+# and starts its network loop, close() tears it down. It reports to the
+# Connection through on_connect(), on_disconnect() and on_message(topic,
+# payload) and never reconnects by itself; a new session is opened instead.
+
+
+class AdafruitTransport:
+    name = "adafruit"
+
+    def __init__(self, username=AIO_USERNAME, key=AIO_KEY):
+        self.username = username
+        self.key = key
+        self._client = None
+
+    def connect(self):
+        client = MQTTClient(self.username, self.key)
+        client.on_connect = lambda c: self.on_connect()
+        client.on_disconnect = lambda c: self.on_disconnect()
+        client.on_message = lambda c, feed_id, payload: self.on_message(feed_id, payload)
+        self._client = client
+        client.connect()
+        client.loop_background()
+
+    def is_connected(self):
+        return self._client is not None and self._client.is_connected()
+
+    def subscribe(self, topic):
+        self._client.subscribe(topic)
+
+    def publish(self, topic, payload):
+        self._client.publish(topic, payload)
+
+    def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            try:
+                client.disconnect()
+                client._client.loop_stop()
+            except Exception as e:
+                print("Error closing Adafruit IO client:", e)
+
+
+class PahoTransport:
+    name = "mqtt"
+
+    def __init__(self, host=LOCAL_MQTT_BROKER or "localhost", port=LOCAL_MQTT_PORT):
+        self.host = host
+        self.port = port
+        self._client = None
+
+    def connect(self):
+        # paho's own reconnection is off: the Connection opens a new session instead
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, reconnect_on_failure=False)
+        client.on_connect = lambda c, userdata, flags, reason_code, properties: (
+            self.on_connect() if not reason_code.is_failure else None)
+        client.on_disconnect = lambda c, userdata, flags, reason_code, properties: self.on_disconnect()
+        client.on_message = lambda c, userdata, msg: self.on_message(msg.topic, msg.payload)
+        self._client = client
+        client.connect(self.host, self.port, KEEP_ALIVE)
+        client.loop_start()
+
+    def is_connected(self):
+        return self._client is not None and self._client.is_connected()
+
+    def subscribe(self, topic):
+        self._client.subscribe(topic, qos=1)
+
+    def publish(self, topic, payload):
+        result = self._client.publish(topic, payload, qos=1)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(mqtt.error_string(result.rc))
+
+    def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            client.disconnect()
+            client.loop_stop()
+
+
+class LoopbackBroker:
+    """
+    In-process broker: messages are delivered to the subscribed loopback
+    transports in publish order on one dispatcher thread.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # topic -> set of LoopbackTransport
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._dispatcher = None
+
+    def subscribe(self, transport, topic):
+        with self._lock:
+            self._subscribers.setdefault(topic, set()).add(transport)
+
+    def unsubscribe_all(self, transport):
+        with self._lock:
+            for subscribers in self._subscribers.values():
+                subscribers.discard(transport)
+
+    def publish(self, topic, payload):
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="loopback-broker", daemon=True)
+                self._dispatcher.start()
+            subscribers = list(self._subscribers.get(topic, ()))
+        for transport in subscribers:
+            self._queue.put((transport, topic, payload))
+
+    def _dispatch(self):
+        while True:
+            transport, topic, payload = self._queue.get()
+            if transport.is_connected():
+                try:
+                    transport.on_message(topic, payload)
+                except Exception as e:
+                    print(f"Error handling loopback message on {topic}:", e)
+
+
+loopback_broker = LoopbackBroker()
+
+
+class LoopbackTransport:
+    name = "loopback"
+
+    def __init__(self, broker=loopback_broker):
+        self.broker = broker
+        self._connected = False
+
+    def connect(self):
+        self._connected = True
+        self.on_connect()
+
+    def is_connected(self):
+        return self._connected
+
+    def subscribe(self, topic):
+        self.broker.subscribe(self, topic)
+
+    def publish(self, topic, payload):
+        if not self._connected:
+            raise ConnectionError("loopback transport closed")
+        self.broker.publish(topic, payload)
+
+    def close(self):
+        if self._connected:
+            self._connected = False
+            self.broker.unsubscribe_all(self)
+            self.on_disconnect()
+
+
+TRANSPORTS = {
+    "adafruit": AdafruitTransport,
+    "mqtt": PahoTransport,
+    "loopback": LoopbackTransport,
+}
+
+###############################################################################
+# Shared connection
+###############################################################################
+class Connection:
+    """
+    Keeps a transport connected for the whole process: a supervisor thread
+    opens it, reopens it with exponential backoff whenever it drops and
+    restores every subscription on each new session. Handlers are called as
+    `handler(connection, topic, payload)`, with `payload` as bytes for
+    binary subscriptions and as text otherwise.
+    """
+
+    def __init__(self, transport, min_delay=RECONNECT_MIN_DELAY, max_delay=RECONNECT_MAX_DELAY):
+        self.transport = transport
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.connects = 0
+        self.last_error = None
+        self._handlers = {}  # topic -> [(handler, binary)]
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._connected = False
+        self._closing = False
+        self._supervisor = None
+        transport.on_connect = self._on_connect
+        transport.on_disconnect = self._on_disconnect
+        transport.on_message = self._on_message
+
+    def subscribe(self, topic, handler, binary=False):
+        with self._lock:
+            new_topic = topic not in self._handlers
+            self._handlers.setdefault(topic, []).append((handler, binary))
+            connected = self._connected
+        if new_topic and connected:
+            try:
+                self.transport.subscribe(topic)
+            except Exception as e:
+                print(f"Error subscribing to {topic}:", e)
+
+    def publish(self, topic, payload):
+        """
+        Hands the message to the broker; raises ConnectionError while
+        disconnected.
+        """
+        if not self.is_connected():
+            raise ConnectionError(f"{self.transport.name} transport is not connected")
+        self.transport.publish(topic, payload)
+
+    def is_connected(self):
+        with self._lock:
+            return self._connected and self.transport.is_connected()
+
+    def wait_connected(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while not self._connected:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return True
+
+    def start(self):
+        """
+        Starts connecting in the background; returns at once.
+        """
+        with self._lock:
+            if self._supervisor is None:
+                self._supervisor = threading.Thread(target=self._supervise, name=f"{self.transport.name}-connection",
+                                                    daemon=True)
+                self._supervisor.start()
+        return self
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+            self._changed.notify_all()
+        self.transport.close()
+
+    def _on_connect(self):
+        with self._lock:
+            topics = list(self._handlers)
+        for topic in topics:
+            try:
+                self.transport.subscribe(topic)
+            except Exception as e:
+                print(f"Error subscribing to {topic}:", e)
+        with self._lock:
+            self._connected = True
+            self.connects += 1
+            self._changed.notify_all()
+        print(f"Connected to {self.transport.name} broker, subscribed to {len(topics)} topic(s)")
+
+    def _on_disconnect(self):
+        with self._lock:
+            self._connected = False
+            self._changed.notify_all()
+        print(f"Disconnected from {self.transport.name} broker!")
+
+    def _on_message(self, topic, payload):
+        with self._lock:
+            handlers = list(self._handlers.get(topic, ()))
+        for handler, binary in handlers:
+            if binary:
+                data = payload.encode() if isinstance(payload, str) else payload
+            else:
+                data = payload.decode("utf-8", "replace") if isinstance(payload, (bytes, bytearray)) else payload
+            try:
+                handler(self, topic, data)
+            except Exception as e:
+                print(f"Error handling message on {topic}:", e)
+
+    def _supervise(self):
+        delay = self.min_delay
+        while True:
+            with self._lock:
+                while not self._closing and self._connected and self.transport.is_connected():
+                    self._changed.wait(HEALTH_CHECK_INTERVAL)
+                if self._closing:
+                    return
+                self._connected = False
+            self.transport.close()
+            try:
+                self.transport.connect()
+                if self.wait_connected(CONNECT_TIMEOUT):
+                    delay = self.min_delay
+                    continue
+                self.last_error = "connection timed out"
+            except Exception as e:
+                self.last_error = str(e)
+            # Jitter keeps door units that lost the broker together from reconnecting in lockstep
+            wait = delay * random.uniform(0.5, 1.0)
+            print(f"Connecting to {self.transport.name} broker failed ({self.last_error}), retrying in {wait:.1f}s")
+            with self._lock:
+                self._changed.wait_for(lambda: self._closing, wait)
+            delay = min(delay * 2, self.max_delay)
+
+    def status(self):
+        with self._lock:
+            return {
+                "transport": self.transport.name,
+                "connected": self._connected,
+                "connects": self.connects,
+                "last_error": self.last_error,
+                "topics": sorted(self._handlers),
+            }
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def connection(kind=MESSAGING_TRANSPORT):
+    """
+    Returns the process wide Connection of a transport kind, started.
+    """
+    with _connections_lock:
+        if kind not in _connections:
+            _connections[kind] = Connection(TRANSPORTS[kind]()).start()
+        return _connections[kind]
+
+
+def connections_status():
+    with _connections_lock:
+        return {kind: shared.status() for kind, shared in _connections.items()}
+
+
 # MQTT Callback Functions
 
 def normal_aio(message):
-    def connected(client):
-        print("Subcribed to Adafruit IO feed")
-        client.subscribe(AIO_FEED)
-        client.subscribe(AIO_FEED_DOOR)
-        client.subscribe(AIO_FEED_LIGHT)
-        client.subscribe(AIO_FEED_BUTTON)
-    def disconnected(client):
-        print("Disconnected from Adafruit IO!")
-    aio_client = MQTTClient(AIO_USERNAME, AIO_KEY)
-    aio_client.on_connect = connected
-    aio_client.on_disconnect = disconnected
-    aio_client.on_message = message
-    return aio_client
+    """
+    Subscribes `message(client, feed_id, payload)` to the device feeds and
+    returns the shared connection.
+    """
+    shared = connection()
+    for feed in (AIO_FEED, AIO_FEED_DOOR, AIO_FEED_LIGHT, AIO_FEED_LED, AIO_FEED_BUTTON):
+        shared.subscribe(feed, message)
+    return shared
 
 
 def aio_listener_img(message):
-    def connected(client):
-        print("Subcribed to Image feed")
-        client.subscribe(AIO_FEED_IMAGE)
-    def disconnected(client):
-        print("Disconnected from Adafruit IO!")
-    aio_client = MQTTClient(AIO_USERNAME, AIO_KEY)
-    aio_client.on_connect = connected
-    aio_client.on_disconnect = disconnected
-    aio_client.on_message = message
-    return aio_client
+    shared = connection()
+    shared.subscribe(AIO_FEED_IMAGE, message)
+    return shared
+
+
+def local_listener_img(message):
+    """
+    Subscribes `message(client, topic, payload bytes)` to the local picture
+    topics, on the shared connection when it already is the local broker.
+    """
+    local = connection(MESSAGING_TRANSPORT if MESSAGING_TRANSPORT != "adafruit" else "mqtt")
+    local.subscribe(TOPIC_IMAGE_SIZE, message, binary=True)
+    local.subscribe(TOPIC_IMAGE_CHUNKS, message, binary=True)
+    return local
 
 
 # aio_client.connect()
@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from face_gallery import FlatIndex, normalise, top_k
+
+###############################################################################
+# Approximate nearest-neighbour index (inverted file, pure NumPy)
+###############################################################################
+# Vectors are clustered around `nlist` centroids (spherical k-means) and stored
+# on disk sorted by cluster, so a probe only scans the `nprobe` closest
+# clusters. The stored arrays are memory-mapped read-only; changes made after
+# the last save live in a small in-memory delta (plus tombstones for the base)
+# until the next compaction rewrites the files.
+IVF_NLIST = int(os.getenv("FACE_IVF_NLIST", "0"))  # 0 = sqrt(gallery size)
+IVF_NPROBE = int(os.getenv("FACE_IVF_NPROBE", "8"))
+KMEANS_ITERATIONS = 10
+# Rewrite the files once the delta/tombstones exceed this share of the base
+COMPACT_RATIO = 0.1
+COMPACT_MIN = 64
+
+INDEX_FILES = ("centroids", "offsets", "keys", "vectors")
+
+
+def kmeans(vectors, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Spherical k-means on normalised vectors, returns (nlist, dim) centroids.
+    """
+    rng = np.random.default_rng(seed)
+    nlist = max(1, min(nlist, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.bincount(assignment, minlength=nlist) == 0
+        # Re-seed empty clusters with random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalise(sums)
+    return centroids
+
+
+def assign(vectors, centroids, chunk=4096):
+    """
+    Returns the index of the closest centroid of every vector.
+    """
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        out[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    """
+    Inverted-file index with the same interface as face_gallery.FlatIndex.
+    With a `path` the index is loaded from / saved to that directory.
+    """
+
+    def __init__(self, path=None, nlist=IVF_NLIST, nprobe=IVF_NPROBE):
+        self.path = path
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self._clear_base()
+        self._delta = {}  # key -> vector added/updated since the last save
+        self._delta_arrays = None
+        if path and os.path.exists(os.path.join(path, "vectors.npy")):
+            self.load()
+
+    def _clear_base(self):
+        self._centroids = None
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._vectors = None
+        self._deleted = np.zeros(0, dtype=bool)
+        self._base_rows = {}  # key -> row in the base arrays
+
+    def __len__(self):
+        return len(self._base_rows) + len(self._delta)
+
+    def __contains__(self, key):
+        return key in self._delta or key in self._base_rows
+
+    # ---------------------------
+    # Persistence
+    # ---------------------------
+    def load(self):
+        arrays = {name: np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r") for name in INDEX_FILES}
+        self._centroids = np.asarray(arrays["centroids"])
+        self._offsets = np.asarray(arrays["offsets"])
+        self._keys = np.asarray(arrays["keys"])
+        self._vectors = arrays["vectors"]
+        self._deleted = np.zeros(len(self._keys), dtype=bool)
+        self._base_rows = {int(key): row for row, key in enumerate(self._keys)}
+        self._delta = {}
+        self._delta_arrays = None
+
+    def save(self):
+        """
+        Merges the delta into the base, re-clusters if the index grew a lot,
+        writes the arrays to `path` and memory-maps them again.
+        """
+        keys, vectors = self.items()
+        centroids, base_size = self._centroids, len(self._keys)
+        self._clear_base()
+        self._delta = {}
+        self._delta_arrays = None
+        if len(keys):
+            # Keep the clustering unless the gallery halved or doubled since it was trained
+            if centroids is None or not len(centroids) or not base_size / 2 <= len(keys) <= base_size * 2 \
+                    or self.nlist not in (0, len(centroids)):
+                centroids = None
+            self._build(keys, vectors, centroids)
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            arrays = {
+                "centroids": self._centroids if self._centroids is not None else np.zeros((0, 0), np.float32),
+                "offsets": self._offsets,
+                "keys": self._keys,
+                "vectors": self._vectors if self._vectors is not None else np.zeros((0, 0), np.float32),
+            }
+            for name, array in arrays.items():
+                tmp_path = os.path.join(self.path, f"{name}.tmp.npy")
+                np.save(tmp_path, array)
+                os.replace(tmp_path, os.path.join(self.path, f"{name}.npy"))
+            self.load()
+
+    def _build(self, keys, vectors, centroids=None):
+        nlist = self.nlist or int(np.sqrt(len(keys)))
+        self._centroids = centroids if centroids is not None else kmeans(vectors, nlist)
+        assignment = assign(vectors, self._centroids)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=len(self._centroids))
+        self._offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._keys = np.asarray(keys, dtype=np.int64)[order]
+        self._vectors = np.ascontiguousarray(vectors[order], dtype=np.float32)
+        self._deleted = np.zeros(len(self._keys), dtype=bool)
+        self._base_rows = {int(key): row for row, key in enumerate(self._keys)}
+
+    def items(self):
+        """
+        Returns (keys, vectors) of every live entry.
+        """
+        live = ~self._deleted
+        keys = [self._keys[live]]
+        vectors = [np.asarray(self._vectors[live]) if self._vectors is not None else np.zeros((0, 0), np.float32)]
+        if self._delta:
+            delta_keys, delta_vectors = self._delta_view()
+            keys.append(delta_keys)
+            vectors.append(delta_vectors)
+        vectors = [v for v in vectors if v.size]
+        return np.concatenate(keys), (np.concatenate(vectors) if vectors else np.zeros((0, 0), np.float32))
+
+    # ---------------------------
+    # Updates
+    # ---------------------------
+    def sync(self, keys, vectors):
+        """
+        Makes the index contain exactly the given entries, reusing the saved
+        base for entries whose vector has not changed.
+        """
+        wanted = dict(zip(keys, vectors))
+        for key in list(self._base_rows):
+            vector = wanted.get(key)
+            if vector is None or not np.allclose(self._vectors[self._base_rows[key]], vector, atol=1e-5):
+                self._drop_base(key)
+        self._delta = {key: vector for key, vector in wanted.items() if key not in self._base_rows}
+        self._delta_arrays = None
+        if self._centroids is None or self._needs_compaction():
+            self.save()
+
+    def _drop_base(self, key):
+        row = self._base_rows.pop(key, None)
+        if row is not None:
+            self._deleted[row] = True
+
+    def add(self, key, vector):
+        self._drop_base(key)
+        self._delta[key] = vector
+        self._delta_arrays = None
+        if self._needs_compaction():
+            self.save()
+
+    def remove(self, key):
+        self._drop_base(key)
+        if self._delta.pop(key, None) is not None:
+            self._delta_arrays = None
+        if self._needs_compaction():
+            self.save()
+
+    def _needs_compaction(self):
+        pending = len(self._delta) + int(self._deleted.sum())
+        return pending > max(COMPACT_MIN, COMPACT_RATIO * len(self._keys))
+
+    # ---------------------------
+    # Search
+    # ---------------------------
+    def _delta_view(self):
+        if self._delta_arrays is None:
+            self._delta_arrays = (np.fromiter(self._delta.keys(), dtype=np.int64, count=len(self._delta)),
+                                  np.stack(list(self._delta.values())).astype(np.float32))
+        return self._delta_arrays
+
+    def search(self, probe, k, nprobe=None):
+        keys, similarities = [], []
+        if self._centroids is not None and len(self._keys):
+            nprobe = min(nprobe or self.nprobe, len(self._centroids))
+            lists = np.argpartition(self._centroids @ probe, -nprobe)[-nprobe:]
+            rows = np.concatenate([np.arange(self._offsets[l], self._offsets[l + 1]) for l in lists])
+            rows = rows[~self._deleted[rows]]
+            keys.append(self._keys[rows])
+            similarities.append(self._vectors[rows] @ probe)
+        if self._delta:
+            delta_keys, delta_vectors = self._delta_view()
+            keys.append(delta_keys)
+            similarities.append(delta_vectors @ probe)
+        if not keys:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return top_k(np.concatenate(keys), np.concatenate(similarities), k)
+
+
+###############################################################################
+# Recall versus latency report
+###############################################################################
+def recall_report(vectors, queries, nlist_values, nprobe_values, k=10):
+    """
+    Compares IVF search against the exact scan for every (nlist, nprobe)
+    pair. Returns one dict per configuration with recall@1, recall@k and the
+    mean search latency in milliseconds.
+    """
+    keys = np.arange(len(vectors))
+    flat = FlatIndex("float32")
+    flat.sync(keys, vectors)
+    start = time.perf_counter()
+    exact = [flat.search(q, k)[0] for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    results = [{"mode": "flat", "recall@1": 1.0, f"recall@{k}": 1.0, "latency_ms": round(exact_ms, 4)}]
+
+    for nlist in nlist_values:
+        index = IVFIndex(nlist=nlist)
+        index.sync(keys, vectors)
+        for nprobe in nprobe_values:
+            start = time.perf_counter()
+            found = [index.search(q, k, nprobe=nprobe)[0] for q in queries]
+            latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            results.append({
+                "mode": "ivf",
+                "nlist": len(index._centroids),
+                "nprobe": nprobe,
+                "recall@1": float(np.mean([f[0] == e[0] for f, e in zip(found, exact)])),
+                f"recall@{k}": float(np.mean([len(np.intersect1d(f, e)) / len(e) for f, e in zip(found, exact)])),
+                "latency_ms": round(latency_ms, 4),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report IVF recall versus latency against the exact scan.")
+    parser.add_argument("--index", help="saved index directory to take the gallery from (default: synthetic)")
+    parser.add_argument("--size", type=int, default=10000, help="synthetic gallery size")
+    parser.add_argument("--dim", type=int, default=512, help="synthetic embedding size")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.5, help="probe noise relative to the embedding norm")
+    parser.add_argument("--nlist", type=int, nargs="+", default=[0])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.index:
+        vectors = np.asarray(IVFIndex(args.index).items()[1])
+    else:
+        vectors = normalise(rng.normal(size=(args.size, args.dim)))
+    # Probes are noisy copies of gallery faces, like a new photo of an enrolled person
+    picked = vectors[rng.choice(len(vectors), args.queries)]
+    noise = rng.normal(size=picked.shape) * args.noise / np.sqrt(vectors.shape[1])
+    queries = normalise(picked + noise)
+
+    for row in recall_report(vectors, queries, args.nlist, args.nprobe, k=args.k):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
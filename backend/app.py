@@ -8,24 +8,54 @@ from flask_jwt_extended import (
 from flask_swagger_ui import get_swaggerui_blueprint
 from flask_cors import CORS
 from datetime import datetime
+from collections import namedtuple
 import pytz
 from sqlalchemy import LargeBinary
 import os
-from deepface import DeepFace
 from sqlalchemy import UniqueConstraint
 # Import Adafruit IO MQTT publishing functionality from separate module
 import adafruit_io_client as aio
-import cv2
-import numpy as np
+import face_embedding as fe
+from face_gallery import FaceGallery, GalleryPartitions
+from ann_index import IVFIndex
+from recognition import engine, recognizer, enrollment_sample, limit_tf_threads
+from frame_assembler import parse_frame
+from frame_chunks import ChunkReassembler
+from recognition_cache import RecognitionCache
+from recognition_pipeline import RecognitionPipeline, UNKNOWN_PERSON
+from profile_report import compare_profiles
+from background_jobs import JobQueue
+from command_queue import CommandQueue, QueueFull
+from device_shadow import DeviceShadow
+from command_acks import AckTracker
 import base64
 import time
+import threading
+import json
+import uuid
+import click
 
 ###############################################################################
 # Adafruit CONFIGURATION
 ###############################################################################
 
+# Device feeds mirrored in the device shadow, served by GET /devices/state
+DEVICE_FEEDS = {
+    aio.AIO_FEED_DOOR: "door",
+    aio.AIO_FEED_LIGHT: "light",
+    aio.AIO_FEED_LED: "led",
+    aio.AIO_FEED_BUTTON: "button",
+}
+device_shadow = DeviceShadow()
+# Door and light reports acknowledge the commands published to them
+ack_tracker = AckTracker({aio.AIO_FEED_DOOR: "door", aio.AIO_FEED_LIGHT: "light"})
+
+
 def message(client, feed_id, payload):#edit this to manipulate aio
-    
+    if feed_id in DEVICE_FEEDS:
+        device_shadow.report(DEVICE_FEEDS[feed_id], payload)
+        ack_tracker.feedback(feed_id, payload)
+
     if feed_id == aio.AIO_FEED:
         print("Message received from Adafruit IO!")
         # Process the message as needed
@@ -42,9 +72,7 @@ def message(client, feed_id, payload):#edit this to manipulate aio
 
 
 
-client = aio.normal_aio(message)
-client.connect()
-client.loop_background()
+client = aio.normal_aio(message)  # shared connection, connects and reconnects in the background
 
 ###############################################################################
 # FLASK APP CONFIGURATION
@@ -55,6 +83,11 @@ CORS(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///data.db'
 app.config['JWT_SECRET_KEY'] = 'supersecretkey'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB limit
+app.config['FACE_INDEX_MODE'] = os.getenv('FACE_INDEX_MODE', 'flat')  # "flat" (exact) or "ivf" (approximate)
+app.config['ENROLL_MAX_IMAGES'] = int(os.getenv('ENROLL_MAX_IMAGES', '10'))  # images per batch enrollment
+# Door and equipment open door commands are logged against for cameras not mapped to a door
+app.config['DEFAULT_DOOR_ID'] = int(os.getenv('DEFAULT_DOOR_ID', '1'))
+app.config['DEFAULT_EQUIPMENT_ID'] = int(os.getenv('DEFAULT_EQUIPMENT_ID', '1'))
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 bcrypt = Bcrypt(app)
@@ -82,8 +115,9 @@ class User(db.Model):
         'polymorphic_identity': 'user'
     }
 
-    # One-to-one relationship to FaceIdentity
-    face_identity = db.relationship('FaceIdentity', backref='user', uselist=False)
+    # One-to-many relationship to FaceIdentity (one row per enrolled face)
+    face_identities = db.relationship('FaceIdentity', backref='user', lazy=True, cascade='all, delete-orphan')
+    place_access = db.relationship('PlaceAccess', backref='user', lazy=True, cascade='all, delete-orphan')
 
 
 class NormalUser(User):
@@ -119,12 +153,34 @@ class FaceIdentity(db.Model):
     face_id = db.Column(db.String(120), nullable=True)          # no longer globally unique
     name = db.Column(db.String(80), nullable=True)
     face_image = db.Column(db.LargeBinary, nullable=True)
+    # True when face_image is an aligned face crop (batch enrollment) rather than a raw photo
+    aligned = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
     __table_args__ = (
         UniqueConstraint('user_id', 'face_id', name='uix_user_face'),
     )
 
+    embeddings = db.relationship('FaceEmbedding', backref='face_identity', lazy=True,
+                                 cascade='all, delete-orphan')
+
+# ---------------------------
+# FaceEmbedding Model (precomputed embedding of a FaceIdentity image)
+# ---------------------------
+class FaceEmbedding(db.Model):
+    __tablename__ = 'face_embedding'
+    id = db.Column(db.Integer, primary_key=True)
+    face_identity_id = db.Column(db.Integer, db.ForeignKey('face_identity.id'), nullable=False)
+    model_name = db.Column(db.String(50), nullable=False)
+    model_version = db.Column(db.String(50), nullable=True)
+    embedding = db.Column(db.LargeBinary, nullable=False)  # see face_embedding.embedding_to_blob
+    dtype = db.Column(db.String(10), nullable=False, default='float32', server_default='float32')
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(VIETNAM_TZ))
+
+    __table_args__ = (
+        UniqueConstraint('face_identity_id', 'model_name', name='uix_face_model'),
+    )
+
 # ---------------------------
 # OpenDoor Log Model
 # ---------------------------
@@ -144,6 +200,22 @@ class Place(db.Model):
     room = db.Column(db.String(120), nullable=True)
     address = db.Column(db.String(120), nullable=True)
     equipment = db.relationship('Equipment', backref='place', lazy=True)
+    access = db.relationship('PlaceAccess', backref='place', lazy=True, cascade='all, delete-orphan')
+
+
+# ---------------------------
+# Place Access Model (users allowed through the doors of a place)
+# ---------------------------
+class PlaceAccess(db.Model):
+    __tablename__ = 'place_access'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    place_id = db.Column(db.Integer, db.ForeignKey('places.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(VIETNAM_TZ))
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'place_id', name='uix_user_place'),
+    )
 
 
 # ---------------------------
@@ -171,6 +243,7 @@ class Door(db.Model):
     __tablename__ = 'door'
     id = db.Column(db.Integer, primary_key=True)
     servo = db.Column(db.String(120), nullable=True)
+    camera_id = db.Column(db.String(80), unique=True, nullable=True)  # camera sending this door's picture feed
     equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.id'), nullable=False)
 
 
@@ -213,6 +286,20 @@ def home():
     return "Welcome! Go to /swagger for API documentation."
 
 
+@app.route('/recognition/status', methods=['GET'])
+def recognition_status():
+    status = engine.status()
+    status['workers'] = recognizer.status()
+    status.update(recognition_pipeline.status())
+    status['chunks'] = chunk_reassembler.status()
+    status['messaging'] = aio.connections_status()
+    status['commands'] = command_queue.status()
+    status['reembedding'] = dict(reembedding)
+    status['partitions'] = gallery_partitions.status()
+    status['ready'] = status['ready'] and status['workers']['ready']
+    return jsonify(status), 200 if status['ready'] else 503
+
+
 # ---------------------------
 # Authentication Routes
 # ---------------------------
@@ -368,17 +455,273 @@ def create_or_update_face_identity():
         return jsonify({'message': 'Face image file is required'}), 400
     image_file = request.files['face_image']
     image_data = image_file.read()
-    if user.face_identity:
-        user.face_identity.face_id = face_id_value
-        user.face_identity.name = face_name
-        user.face_identity.face_image = image_data
+    face = FaceIdentity.query.filter_by(user_id=user.id, face_id=face_id_value).first()
+    image_changed = face is None or face.face_image != image_data
+    if face:
+        face.name = face_name
+        face.face_image = image_data
+        face.aligned = False
     else:
-        new_face = FaceIdentity(face_id=face_id_value, name=face_name, face_image=image_data, user_id=user.id)
-        db.session.add(new_face)
+        face = FaceIdentity(face_id=face_id_value, name=face_name, face_image=image_data, user_id=user.id)
+        db.session.add(face)
+    if image_changed or get_face_embedding(face) is None:
+        try:
+            save_face_embedding(face, engine.embed(fe.decode_image(image_data)))
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'message': 'No face detected in image', 'error': str(e)}), 400
     db.session.commit()
+    row = get_face_embedding(face)
+    gallery_upsert(face, fe.blob_to_embedding(row.embedding, row.dtype))
     return jsonify({'message': 'Face identity saved/updated'}), 200
 
 
+@app.route('/face_identity/batch', methods=['POST'])
+@jwt_required()
+def enroll_face_samples():
+    """
+    Queues several enrollment images of the current user. Each one becomes a
+    face_identity row holding only its normalised face crop and embedding.
+    """
+    current_user_id = int(get_jwt_identity())
+    user = User.query.get(current_user_id)
+    if not user:
+        return jsonify({'message': 'User not found'}), 404
+    images = [f.read() for f in request.files.getlist('face_images')]
+    images = [image for image in images if image]
+    if not images:
+        return jsonify({'message': 'At least one face_images file is required'}), 400
+    if len(images) > app.config['ENROLL_MAX_IMAGES']:
+        return jsonify({'message': f"At most {app.config['ENROLL_MAX_IMAGES']} images per batch"}), 400
+    job = enrollment_jobs.submit(
+        lambda job: enroll_samples(job, images),
+        user_id=user.id,
+        name=request.form.get('name') or user.name,
+        samples=[{'status': 'queued'} for _ in images],
+    )
+    return jsonify({'job_id': job['id'], 'status': job['status']}), 202
+
+
+@app.route('/face_identity/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_enrollment_job(job_id):
+    job = enrollment_jobs.get(job_id)
+    if job is None or job['user_id'] != int(get_jwt_identity()):
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job), 200
+
+
+def enroll_samples(job, images):
+    """
+    Background job: detects, crops and embeds each image of a batch and
+    stores the accepted ones as new face identities.
+    """
+    for i, image_data in enumerate(images):
+        try:
+            crop_jpeg, embedding = enrollment_sample(image_data)
+        except Exception as e:
+            job['samples'][i] = {'status': 'rejected', 'reason': str(e)}
+            continue
+        with app.app_context():
+            face = FaceIdentity(face_id=f"sample-{uuid.uuid4().hex[:12]}", name=job['name'],
+                                face_image=crop_jpeg, aligned=True, user_id=job['user_id'])
+            db.session.add(face)
+            save_face_embedding(face, embedding)
+            db.session.commit()
+            gallery_upsert(face, embedding)
+            job['samples'][i] = {'status': 'enrolled', 'face_identity_id': face.id, 'face_id': face.face_id}
+    job['enrolled'] = sum(1 for sample in job['samples'] if sample['status'] == 'enrolled')
+
+
+def get_face_embedding(face):
+    """
+    Returns the stored embedding row of `face` for the current model, or None
+    if it is missing or was computed by another model version.
+    """
+    for row in face.embeddings:
+        if row.model_name == fe.MODEL_NAME and row.model_version == fe.MODEL_VERSION:
+            return row
+    return None
+
+
+def save_face_embedding(face, embedding):
+    row = next((r for r in face.embeddings if r.model_name == fe.MODEL_NAME), None)
+    if row is None:
+        row = FaceEmbedding(model_name=fe.MODEL_NAME)
+        face.embeddings.append(row)
+    row.model_version = fe.MODEL_VERSION
+    row.embedding = fe.embedding_to_blob(embedding, fe.EMBEDDING_DTYPE)
+    row.dtype = fe.EMBEDDING_DTYPE
+    row.updated_at = datetime.now(VIETNAM_TZ)
+    return row
+
+
+def embed_face_identity(face):
+    """
+    Embeds the stored image of `face`; aligned crops skip face detection.
+    """
+    image = fe.decode_image(face.face_image)
+    if face.aligned:
+        return engine.embed_face(image)
+    return engine.embed(image)
+
+
+def load_face_gallery():
+    """
+    Yields (face_identity_id, user_id, name, embedding) for every enrolled
+    face with an up-to-date embedding. Faces without one (newly migrated, or
+    embedded by another profile's model) are re-embedded in the background.
+    """
+    missing = []
+    with app.app_context():
+        for face in FaceIdentity.query.all():
+            row = get_face_embedding(face)
+            if row is None:
+                missing.append(face.id)
+                continue
+            yield face.id, face.user_id, face.name, fe.blob_to_embedding(row.embedding, row.dtype)
+    if missing:
+        queue_reembedding(missing)
+
+
+# Background re-embedding: after switching to a profile with another model,
+# matching keeps working on the faces embedded so far while the rest are
+# embedded one by one and added to the gallery.
+reembedding = {"pending": 0, "done": 0, "failed": 0}
+_reembed_queue = []
+_reembed_lock = threading.Lock()
+_reembed_thread = None
+
+
+def queue_reembedding(face_ids):
+    global _reembed_thread
+    with _reembed_lock:
+        queued = set(_reembed_queue)
+        _reembed_queue.extend(face_id for face_id in face_ids if face_id not in queued)
+        reembedding['pending'] = len(_reembed_queue)
+        if _reembed_thread is None:
+            print(f"Re-embedding {len(_reembed_queue)} face identities with {fe.MODEL_NAME} in the background")
+            _reembed_thread = threading.Thread(target=reembed_faces, name="face-reembedding", daemon=True)
+            _reembed_thread.start()
+
+
+def reembed_faces():
+    global _reembed_thread
+    while True:
+        with _reembed_lock:
+            if not _reembed_queue:
+                _reembed_thread = None
+                return
+            face_id = _reembed_queue.pop(0)
+            reembedding['pending'] = len(_reembed_queue)
+        with app.app_context():
+            face = FaceIdentity.query.get(face_id)
+            if face is None or get_face_embedding(face) is not None:
+                continue
+            try:
+                embedding = embed_face_identity(face)
+                save_face_embedding(face, embedding)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                reembedding['failed'] += 1
+                print(f"Error embedding face identity {face_id}:", e)
+                continue
+            gallery_upsert(face, embedding)
+            reembedding['done'] += 1
+
+
+def create_face_index():
+    """
+    Returns the ANN index for the gallery when FACE_INDEX_MODE is "ivf"
+    (saved next to the database), or None for the exact flat scan.
+    """
+    if app.config['FACE_INDEX_MODE'] == 'ivf':
+        return IVFIndex(os.path.join(app.instance_path, f"face_index_{fe.MODEL_NAME}"))
+    return None
+
+
+face_gallery = FaceGallery(load_face_gallery, index=create_face_index(), model_name=fe.MODEL_NAME,
+                           threshold=fe.PROFILE.threshold)
+enrollment_jobs = JobQueue('enrollment')
+
+
+# ---------------------------
+# Door access partitions
+# ---------------------------
+# A camera is mapped to a door through Door.camera_id. Bursts from a camera
+# at a door of a place are only matched against the faces of users with
+# PlaceAccess there; cameras not mapped to a door (or a door without a
+# place) match against every enrolled face, as before doors were configured.
+DoorTarget = namedtuple('DoorTarget', ['door_id', 'equipment_id', 'place_id'])
+_camera_doors = None  # camera_id -> DoorTarget, loaded on first use
+_camera_doors_lock = threading.Lock()
+
+
+def camera_door(camera_id):
+    """
+    Returns the DoorTarget of the door `camera_id` is mounted at, or None.
+    """
+    global _camera_doors
+    with _camera_doors_lock:
+        if _camera_doors is None:
+            with app.app_context():
+                _camera_doors = {
+                    door.camera_id: DoorTarget(door.id, door.equipment_id, door.equipment.place_id)
+                    for door in Door.query.filter(Door.camera_id.isnot(None)).all()
+                }
+        return _camera_doors.get(camera_id)
+
+
+def invalidate_camera_doors():
+    """
+    Called when doors, their equipment or places change.
+    """
+    global _camera_doors
+    with _camera_doors_lock:
+        _camera_doors = None
+
+
+def load_place_gallery(place_id):
+    """
+    Yields the gallery rows of the faces of users allowed at `place_id`.
+    Faces without an up-to-date embedding are re-embedded in the background,
+    as in load_face_gallery().
+    """
+    missing = []
+    with app.app_context():
+        faces = FaceIdentity.query.join(PlaceAccess, PlaceAccess.user_id == FaceIdentity.user_id)\
+            .filter(PlaceAccess.place_id == place_id).all()
+        for face in faces:
+            row = get_face_embedding(face)
+            if row is None:
+                missing.append(face.id)
+                continue
+            yield face.id, face.user_id, face.name, fe.blob_to_embedding(row.embedding, row.dtype)
+    if missing:
+        queue_reembedding(missing)
+
+
+gallery_partitions = GalleryPartitions(load_place_gallery, model_name=fe.MODEL_NAME, threshold=fe.PROFILE.threshold)
+
+
+def gallery_for_camera(camera_id):
+    door = camera_door(camera_id)
+    if door is None or door.place_id is None:
+        return face_gallery
+    return gallery_partitions.get(door.place_id)
+
+
+def gallery_upsert(face, embedding):
+    """
+    Adds or replaces `face` in the gallery and in the partitions of the
+    places its user may enter.
+    """
+    face_gallery.upsert(face.id, face.user_id, face.name, embedding)
+    place_ids = {a.place_id for a in PlaceAccess.query.filter_by(user_id=face.user_id).all()}
+    gallery_partitions.upsert(place_ids, face.id, face.user_id, face.name, embedding)
+
+
 # ---------------------------
 # Place Routes
 # ---------------------------
@@ -433,9 +776,60 @@ def delete_place(place_id):
         return jsonify({"message": "Place not found"}), 404
     db.session.delete(place)
     db.session.commit()
+    gallery_partitions.drop(place_id)
+    invalidate_camera_doors()
     return jsonify({"message": "Place deleted"}), 200
 
 
+@app.route('/places/<int:place_id>/access', methods=['GET'])
+@jwt_required()
+def get_place_access(place_id):
+    place = Place.query.get(place_id)
+    if not place:
+        return jsonify({"message": "Place not found"}), 404
+    output = [{"user_id": a.user_id, "name": a.user.name, "created_at": a.created_at.isoformat()} for a in place.access]
+    return jsonify(output), 200
+
+
+@app.route('/places/<int:place_id>/access', methods=['POST'])
+@jwt_required()
+def grant_place_access(place_id):
+    current_user = User.query.get(int(get_jwt_identity()))
+    if current_user.type != 'admin':
+        return jsonify({"message": "Unauthorized: admin access required"}), 403
+    place = Place.query.get(place_id)
+    if not place:
+        return jsonify({"message": "Place not found"}), 404
+    user = User.query.get(request.json.get('user_id'))
+    if not user:
+        return jsonify({"message": "User not found"}), 404
+    if PlaceAccess.query.filter_by(user_id=user.id, place_id=place_id).first():
+        return jsonify({"message": "Access already granted"}), 200
+    db.session.add(PlaceAccess(user_id=user.id, place_id=place_id))
+    db.session.commit()
+    partition = gallery_partitions.get(place_id)
+    for face in user.face_identities:
+        row = get_face_embedding(face)
+        if row is not None:
+            partition.upsert(face.id, face.user_id, face.name, fe.blob_to_embedding(row.embedding, row.dtype))
+    return jsonify({"message": "Access granted"}), 201
+
+
+@app.route('/places/<int:place_id>/access/<int:user_id>', methods=['DELETE'])
+@jwt_required()
+def revoke_place_access(place_id, user_id):
+    current_user = User.query.get(int(get_jwt_identity()))
+    if current_user.type != 'admin':
+        return jsonify({"message": "Unauthorized: admin access required"}), 403
+    access = PlaceAccess.query.filter_by(user_id=user_id, place_id=place_id).first()
+    if not access:
+        return jsonify({"message": "Access not found"}), 404
+    db.session.delete(access)
+    db.session.commit()
+    gallery_partitions.remove_user(user_id, keys={place_id})
+    return jsonify({"message": "Access revoked"}), 200
+
+
 # ---------------------------
 # Equipment Routes
 # ---------------------------
@@ -461,7 +855,7 @@ def get_equipment_endpoint(equipment_id):
     if not eq:
         return jsonify({"message": "Equipment not found"}), 404
     lights = [{"id": l.id, "switch": l.switch} for l in eq.lights]
-    doors = [{"id": d.id, "servo": d.servo} for d in eq.doors]
+    doors = [{"id": d.id, "servo": d.servo, "camera_id": d.camera_id} for d in eq.doors]
     return jsonify({
         "id": eq.id,
         "name": eq.name,
@@ -500,6 +894,7 @@ def update_equipment_endpoint(equipment_id):
     eq.status = data.get('status', eq.status)
     eq.place_id = data.get('place_id', eq.place_id)
     db.session.commit()
+    invalidate_camera_doors()
     return jsonify({"message": "Equipment updated"}), 200
 
 
@@ -511,6 +906,7 @@ def delete_equipment_endpoint(equipment_id):
         return jsonify({"message": "Equipment not found"}), 404
     db.session.delete(eq)
     db.session.commit()
+    invalidate_camera_doors()
     return jsonify({"message": "Equipment deleted"}), 200
 
 # ---------------------------
@@ -518,8 +914,7 @@ def delete_equipment_endpoint(equipment_id):
 # ---------------------------
 @app.route('/equipment/<int:equipment_id>/lights', methods=['POST'])
 @jwt_required()
-def create_light_endpoint():
-    equipment_id = request.view_args['equipment_id']
+def create_light_endpoint(equipment_id):
     eq = Equipment.query.get(equipment_id)
     if not eq:
         return jsonify({"message": "Equipment not found"}), 404
@@ -546,16 +941,19 @@ def get_lights_for_equipment(equipment_id):
 # ---------------------------
 @app.route('/equipment/<int:equipment_id>/doors', methods=['POST'])
 @jwt_required()
-def create_door_endpoint():
-    equipment_id = request.view_args['equipment_id']
+def create_door_endpoint(equipment_id):
     eq = Equipment.query.get(equipment_id)
     if not eq:
         return jsonify({"message": "Equipment not found"}), 404
     data = request.json
     servo_value = data.get('servo', 'default_servo')
-    door = Door(servo=servo_value, equipment_id=equipment_id)
+    camera_id = data.get('camera_id')
+    if camera_id and Door.query.filter_by(camera_id=camera_id).first():
+        return jsonify({"message": "Camera already mapped to another door"}), 400
+    door = Door(servo=servo_value, camera_id=camera_id, equipment_id=equipment_id)
     db.session.add(door)
     db.session.commit()
+    invalidate_camera_doors()
     return jsonify({"message": "Door created", "id": door.id}), 201
 
 
@@ -565,10 +963,123 @@ def get_doors_for_equipment(equipment_id):
     eq = Equipment.query.get(equipment_id)
     if not eq:
         return jsonify({"message": "Equipment not found"}), 404
-    doors = [{"id": d.id, "servo": d.servo} for d in eq.doors]
+    doors = [{"id": d.id, "servo": d.servo, "camera_id": d.camera_id} for d in eq.doors]
     return jsonify(doors), 200
 
 
+@app.route('/equipment/<int:equipment_id>/doors/<int:door_id>', methods=['PUT'])
+@jwt_required()
+def update_door_endpoint(equipment_id, door_id):
+    door = Door.query.filter_by(id=door_id, equipment_id=equipment_id).first()
+    if not door:
+        return jsonify({"message": "Door not found"}), 404
+    data = request.json
+    camera_id = data.get('camera_id', door.camera_id)
+    if camera_id and Door.query.filter(Door.camera_id == camera_id, Door.id != door.id).first():
+        return jsonify({"message": "Camera already mapped to another door"}), 400
+    door.servo = data.get('servo', door.servo)
+    door.camera_id = camera_id
+    db.session.commit()
+    invalidate_camera_doors()
+    return jsonify({"message": "Door updated"}), 200
+
+
+# ---------------------------
+# Device state
+# ---------------------------
+def persist_device_states(states):
+    """
+    Writes states from the device shadow to the Light and Door rows. All
+    lights share one feed and all doors another, so a feed's state applies
+    to every row of its table.
+    """
+    with app.app_context():
+        if 'light' in states:
+            switch = states['light'].strip().upper() in ('ON', '1', 'TRUE')
+            Light.query.update({Light.switch: switch})
+        if 'door' in states:
+            servo = {'ON': 'open', 'OFF': 'closed'}.get(states['door'].strip().upper(), states['door'])
+            Door.query.update({Door.servo: servo})
+        db.session.commit()
+
+
+device_shadow.start(persist_device_states)
+
+
+def shadow_time(timestamp):
+    return datetime.fromtimestamp(timestamp, VIETNAM_TZ).isoformat() if timestamp else None
+
+
+@app.route('/devices/state', methods=['GET'])
+@jwt_required()
+def get_device_states():
+    """
+    Current device states from the shadow; with ?since=<version> only the
+    devices that changed after that version.
+    """
+    since = request.args.get('since', 0, type=int)
+    version, devices = device_shadow.snapshot(since)
+    return jsonify({
+        "version": version,
+        "persisted_at": shadow_time(device_shadow.persisted_at),
+        "devices": {name: {
+            "value": state["value"],
+            "version": state["version"],
+            "updated_at": shadow_time(state["updated_at"]),
+            "reported_at": shadow_time(state["reported_at"]),
+        } for name, state in devices.items()},
+    }), 200
+
+
+# ---------------------------
+# Device commands
+# ---------------------------
+def record_command_outcome(control_id, status, error):
+    """
+    Stores the delivery outcome of a queued command on its Control row.
+    """
+    if status == 'failed':
+        ack_tracker.cancel(control_id)
+    with app.app_context():
+        control = Control.query.get(control_id)
+        if control is None or control.status != 'queued':
+            return  # already acknowledged by the device
+        control.status = status
+        if status == 'sent':
+            control.start_time = datetime.now(VIETNAM_TZ)
+        db.session.commit()
+
+
+def record_command_ack(control_id, status, latency):
+    """
+    Marks a published command acknowledged by its device, or timed out.
+    """
+    with app.app_context():
+        control = Control.query.get(control_id)
+        if control is None or control.status not in ('queued', 'sent'):
+            return
+        control.status = status
+        if status == 'acknowledged':
+            control.end_time = datetime.now(VIETNAM_TZ)
+            print(f"{control.device_type.capitalize()} {control.device_id} acknowledged "
+                  f"'{control.action}' in {latency * 1000:.0f} ms")
+        db.session.commit()
+
+
+ack_tracker.start(record_command_ack)
+command_queue = CommandQueue(client, on_outcome=record_command_outcome, on_publish=ack_tracker.publishing)
+
+
+@app.route('/controls/latency', methods=['GET'])
+@jwt_required()
+def get_control_latency():
+    """
+    Per device type: acknowledged, timed out and pending commands, and the
+    publish to acknowledgement latency histogram in milliseconds.
+    """
+    return jsonify({"ack_timeout": ack_tracker.timeout, "devices": ack_tracker.status()}), 200
+
+
 # ---------------------------
 # Control Routes (Actions)
 # ---------------------------
@@ -594,41 +1105,39 @@ def create_control():
     if feed is None:
         return jsonify({"message": "Unsupported device type"}), 400
 
+    on_action = "open door" if device_type == "door" else "turn on light"
+    command = "ON" if action == on_action else "OFF"
+
+    # The command is published by the background sender, which records
+    # whether it was sent, superseded or failed on the row
     control = Control(
         action=action,
         device_type=device_type,
         device_id=device_id,
         equipment_id=equipment_id,
         user_id=current_user_id,
-        status=data.get('status', 'pending')
+        status='queued'
     )
     db.session.add(control)
-    db.session.flush()
+    db.session.commit()
 
     try:
-        if action == "open door" or action == "close door":
-            client.publish(feed, "ON") if action == "open door" else client.publish(feed, "OFF")  
-            print(f"Published to {feed}: {'ON' if action == 'open door' else 'OFF'}")
-        else:
-            client.publish(feed, "ON") if action == "turn on light" else client.publish(feed, "OFF")
-        control.status     = 'sent'
-        control.start_time = datetime.now(VIETNAM_TZ)
+        command_queue.submit(feed, command, ref=control.id)
+    except QueueFull as e:
+        control.status = 'failed'
         db.session.commit()
+        return jsonify({"message": "Failed to send command", "error": str(e)}), 503
 
-        return jsonify({
-            "message": f"Command '{action}' sent to {device_type}.",
-            "control": {
-                "id":          control.id,
-                "action":      control.action,
-                "device_type": control.device_type,
-                "device_id":   control.device_id,
-                "status":      control.status
-            }
-        }), 201
-
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Failed to send command", "error": str(e)}), 500
+    return jsonify({
+        "message": f"Command '{action}' queued for {device_type}.",
+        "control": {
+            "id":          control.id,
+            "action":      control.action,
+            "device_type": control.device_type,
+            "device_id":   control.device_id,
+            "status":      control.status
+        }
+    }), 201
 
 
 @app.route('/controls', methods=['GET'])
@@ -693,8 +1202,12 @@ def admin_delete_normal_user(user_id):
         return jsonify({"message": "User not found"}), 404
     if target_user.type != 'normal' and target_user.type != 'admin':
         return jsonify({"message": "Cannot delete an admin user via this endpoint"}), 400
+    face_ids = [face.id for face in target_user.face_identities]
     db.session.delete(target_user)
     db.session.commit()
+    for face_id in face_ids:
+        face_gallery.remove(face_id)
+    gallery_partitions.remove_user(user_id)
     return jsonify({"message": "Normal user deleted successfully"}), 200
 import base64
 
@@ -740,70 +1253,108 @@ def get_latest_open_door_logs():
 ###############################################################################
 # AI module (Adafruit IO Image Processing)
 ###############################################################################
-img_counter = 0
 def img_message(client, feed_id, payload):
     if feed_id == aio.AIO_FEED_IMAGE:
         # print("Image received from Adafruit IO!")
-        global img_counter
-        img_counter += 1
         try:
-            # Decode Base64 data
-            image_data = base64.b64decode(payload)
-            image_name = f"{img_counter}.jpg"
-            with open(image_name, "wb") as img_file:
-                img_file.write(image_data)
-            print(f"Image saved as {img_counter}.jpg")
+            header, image_b64 = parse_frame(payload)
+            # Decode Base64 data once; the JPEG bytes stay in memory for logging
+            image_data = base64.b64decode(image_b64)
         except Exception as e:
             print("Error processing image:", e)
-        if img_counter == 2:
-            img_counter = 0
-            with app.app_context():
-                ids = db.session.execute(db.select(FaceIdentity.name, FaceIdentity.face_image, FaceIdentity.user_id)).all()
-            ids = [(x[0],cv2.imdecode(np.fromstring(x[1], np.uint8),cv2.IMREAD_COLOR),x[2]) for x in ids] #npdarray of bgr
-            flag = False
-            for i in range(5):
-                img_name = f"{i+1}.jpg"
-                if not os.path.exists(img_name):
-                    continue
-                if not flag:
-                    for id in ids:
-                        try:
-                            result = DeepFace.verify(img_name, id[1], model_name='Facenet512')
-                            if result['verified']:
-                                client.publish(aio.AIO_FEED_DOOR, "ON")
-                                client.publish(aio.AIO_FEED, id[0])
-                                with app.app_context():
-                                    db.session.add(Control(
-                                        action="open door",
-                                        device_type="door",
-                                        device_id=1,
-                                        status="sent",
-                                        user_id=id[2],  
-                                        equipment_id=1  
-                                    ))
-                                    db.session.add(OpenDoorLog(name=id[0], timestamp=datetime.now(VIETNAM_TZ)))
-                                    db.session.commit()
-                                flag = True
-                                break
-                        except Exception as e:
-                            print("Error in verification:", e)
-                # os.remove(img_name)
-            if not flag:
-                client.publish(aio.AIO_FEED, "Unknown Person")
-                img_data = None
-                with open(img_name, "rb") as image_file:
-                    img_data = image_file.read()
-                with app.app_context():
-                    if img_data:
-                        print(type(img_data))
-                        db.session.add(OpenDoorLog(name="Unknown Person", timestamp=datetime.now(VIETNAM_TZ), unknown_person=img_data))
-                        db.session.commit()
+            return
+        recognition_pipeline.submit(header, image_data)
+
+
+def publish_decision(*commands):
+    for feed, command, control_id in commands:
+        try:
+            command_queue.submit(feed, command, ref=control_id)
+        except QueueFull as e:
+            print(f"Command {command} to {feed} dropped:", e)
+            if control_id is not None:
+                record_command_outcome(control_id, 'failed', str(e))
+
+
+def handle_decision(camera_id, decision):
+    """
+    Opens the door for a verified match, otherwise logs the burst as an
+    unknown person.
+    """
+    match = decision.match
+    door = camera_door(camera_id)
+    if match and match.verified:
+        print(f"Matched {match.name} from {decision.frames} frame(s)"
+              f"{' (early)' if decision.early else ''} in {decision.elapsed:.2f}s: "
+              f"distance={match.distance:.3f}, margin={match.margin:.3f}")
+        if door is None:
+            print(f"Camera {camera_id} is not mapped to a door, logging the default door")
+            door = DoorTarget(app.config['DEFAULT_DOOR_ID'], app.config['DEFAULT_EQUIPMENT_ID'], None)
+        with app.app_context():
+            control = Control(
+                action="open door",
+                device_type="door",
+                device_id=door.door_id,
+                status="queued",
+                user_id=match.user_id,
+                equipment_id=door.equipment_id
+            )
+            db.session.add(control)
+            db.session.add(OpenDoorLog(name=match.name, timestamp=datetime.now(VIETNAM_TZ)))
+            db.session.commit()
+            control_id = control.id
+        publish_decision((aio.AIO_FEED_DOOR, "ON", control_id), (aio.AIO_FEED, match.name, None))
+        return
+    publish_decision((aio.AIO_FEED, UNKNOWN_PERSON, None))
+    img_data = decision.image_data
+    with app.app_context():
+        if img_data:
+            db.session.add(OpenDoorLog(name=UNKNOWN_PERSON, timestamp=datetime.now(VIETNAM_TZ), unknown_person=img_data))
+            db.session.commit()
+
+
+recognition_pipeline = RecognitionPipeline(face_gallery, handle_decision, recognizer, cache=RecognitionCache(),
+                                           gallery_for=gallery_for_camera)
+chunk_reassembler = ChunkReassembler(recognition_pipeline.submit)
+
+
+def chunk_message(client, topic, payload):
+    """
+    Frames sent raw in chunks over the local broker; they join the same
+    pipeline as the picture feed.
+    """
+    if topic == aio.TOPIC_IMAGE_SIZE:
+        chunk_reassembler.add_header(payload)
+    elif topic == aio.TOPIC_IMAGE_CHUNKS:
+        chunk_reassembler.add_chunk(payload)
+
+
+###############################################################################
+# CLI
+###############################################################################
+@app.cli.command('profile-report')
+@click.option('--profile', 'profiles', multiple=True, type=click.Choice(list(fe.PROFILES)),
+              help='Profile to evaluate (repeatable, default: all).')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON report to this file.')
+def profile_report_command(profiles, output):
+    """Compares the latency and accuracy of the recognition profiles on the enrolled faces."""
+    faces = [(f.id, f.user_id, f.name, f.face_image, f.aligned) for f in FaceIdentity.query.all() if f.face_image]
+    report = json.dumps({"active_profile": fe.PROFILE.name,
+                         "results": compare_profiles(faces, profiles or None)}, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
 
 ###############################################################################
 # RUN THE APP
 ###############################################################################
 if __name__ == '__main__':
-    img_aio_client = aio.aio_listener_img(img_message) 
-    img_aio_client.connect()
-    img_aio_client.loop_background()  # Keep MQTT connection alive in the background
+    limit_tf_threads()
+    recognizer.start()  # fork the recognition workers before this process loads the model
+    engine.start()  # build and warm up the recognition model before the first door event
+    aio.aio_listener_img(img_message)
+    if aio.LOCAL_MQTT_BROKER or aio.MESSAGING_TRANSPORT != "adafruit":
+        aio.local_listener_img(chunk_message)
     app.run(debug=True)
@@ -0,0 +1,84 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+###############################################################################
+# Background jobs
+###############################################################################
+# Slow work requested through the API (e.g. embedding enrollment images) runs
+# on one worker thread so the request returns at once with a job id to poll.
+# Jobs live in memory only: the most recent MAX_JOBS are kept for status
+# queries, and queued jobs are lost on restart.
+MAX_JOBS = 256
+
+
+class JobQueue:
+    def __init__(self, name, max_jobs=MAX_JOBS):
+        self.name = name
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()  # id -> job dict, oldest first
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._worker = None
+
+    def submit(self, fn, **info):
+        """
+        Queues `fn(job)`; `job` is a dict holding `info` that `fn` may update
+        to report progress. Returns a snapshot of the new job.
+        """
+        job = dict(info, id=uuid.uuid4().hex, status="queued", created_at=time.time(),
+                   started_at=None, finished_at=None, error=None)
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self._queue.append((job, fn))
+            self._evict()
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=f"{self.name}-jobs", daemon=True)
+                self._worker.start()
+            self._wakeup.notify()
+            return self._snapshot(job)
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in ("done", "failed")]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        Returns a snapshot of the job, or None if it is unknown or expired.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+
+    @staticmethod
+    def _snapshot(job):
+        return {key: list(value) if isinstance(value, list) else value for key, value in job.items()}
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._wakeup.wait()
+                job, fn = self._queue.popleft()
+                job["status"] = "running"
+                job["started_at"] = time.time()
+            try:
+                fn(job)
+                status, error = "done", None
+            except Exception as e:
+                print(f"Error in {self.name} job {job['id']}:", e)
+                status, error = "failed", str(e)
+            with self._lock:
+                job["status"] = status
+                job["error"] = error
+                job["finished_at"] = time.time()
+
+    def status(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
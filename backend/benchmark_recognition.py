@@ -0,0 +1,298 @@
+import os
+import sys
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+import face_embedding as fe
+from face_gallery import FaceGallery, FlatIndex, normalise, EMBEDDING_DTYPE, EMBEDDING_DTYPES
+from ann_index import IVFIndex
+from frame_assembler import BURST_SIZE, BURST_MAX_FRAMES, FrameHeader
+from recognition import (engine, embed_frame, FrameResult, Recognizer, RECOGNITION_EXECUTOR,
+                         RECOGNITION_WORKERS, RECOGNITION_QUEUE_SIZE, _init_worker)
+from recognition_pipeline import RecognitionPipeline
+
+###############################################################################
+# Offline recognition benchmark
+###############################################################################
+# Replays probe bursts through RecognitionPipeline, the same path img_message
+# uses, without MQTT or the database, against galleries of several sizes.
+#
+# With --images DIR (one sub-directory of JPEGs per person) part of the people
+# are enrolled from their first image and every other image is a probe; the
+# remaining people are impostors. The gallery is padded up to each size with
+# random synthetic embeddings, which stress the matcher but are easier to
+# reject than real faces. Without --images everything is synthetic and the
+# worker job only unpacks a precomputed embedding, so only matching and the
+# burst decision are measured. Progress goes to stderr, the JSON report to
+# stdout or --output.
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def synthetic_frame(data):
+    """
+    Worker job for synthetic probes: the frame is the embedding itself.
+    """
+    return FrameResult(np.frombuffer(data, dtype=np.float32), 1.0, None, {})
+
+
+def noisy(vectors, noise, rng):
+    """
+    Returns copies of normalised `vectors` with gaussian noise of relative norm `noise`.
+    """
+    vectors = np.atleast_2d(vectors)
+    return normalise(vectors + rng.normal(size=vectors.shape) * noise / np.sqrt(vectors.shape[1]))
+
+
+def load_people(path):
+    """
+    Returns {person: [JPEG bytes, ...]} from a directory of per-person directories.
+    """
+    people = {}
+    for person in sorted(os.listdir(path)):
+        folder = os.path.join(path, person)
+        if not os.path.isdir(folder):
+            continue
+        images = []
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(folder, name), "rb") as f:
+                    images.append(f.read())
+        if images:
+            people[person] = images
+    return people
+
+
+def image_dataset(path, impostor_ratio, burst_size, rng):
+    """
+    Enrolls part of the people in `path` and builds their probe bursts.
+    Returns (gallery rows, bursts) where a burst is (expected user_id or
+    None for an impostor, [frame, ...]).
+    """
+    people = load_people(path)
+    names = list(people)
+    rng.shuffle(names)
+    impostors = set(names[:int(round(len(names) * impostor_ratio))])
+    rows, bursts = [], []
+    for user_id, name in enumerate(names, start=1):
+        images = people[name]
+        if name not in impostors:
+            try:
+                embedding = engine.embed(fe.decode_image(images[0]))
+            except ValueError as e:
+                print(f"No face detected in the enrollment image of {name}, skipped:", e, file=sys.stderr)
+                continue
+            rows.append((user_id, user_id, name, embedding))
+            images = images[1:]
+        for start in range(0, len(images), burst_size):
+            bursts.append((None if name in impostors else user_id, images[start:start + burst_size]))
+    return rows, bursts
+
+
+def synthetic_bursts(vectors, count, impostor_ratio, burst_size, noise, rng):
+    """
+    Builds `count` bursts of noisy embeddings: genuine ones around gallery
+    vectors and impostor ones around new random vectors.
+    """
+    bursts = []
+    for _ in range(count):
+        if rng.random() < impostor_ratio:
+            expected, center = None, normalise(rng.normal(size=vectors.shape[1]))
+        else:
+            row = int(rng.integers(len(vectors)))
+            expected, center = row + 1, vectors[row]
+        frames = noisy(np.repeat(center[None], burst_size, axis=0), noise, rng)
+        bursts.append((expected, [frame.astype(np.float32).tobytes() for frame in frames]))
+    return bursts
+
+
+def build_gallery(rows, size, dim, index, dtype, rng):
+    """
+    Returns a loaded FaceGallery of `rows` padded with synthetic identities
+    to `size`, and its normalised vectors.
+    """
+    rows = list(rows)
+    padding = max(0, size - len(rows))
+    first = max((row[0] for row in rows), default=0) + 1
+    extra = normalise(rng.normal(size=(padding, dim)))
+    rows += [(first + i, first + i, f"synthetic-{i}", vector) for i, vector in enumerate(extra)]
+    gallery = FaceGallery(lambda: rows, index=IVFIndex() if index == "ivf" else FlatIndex(dtype),
+                          model_name=fe.MODEL_NAME, threshold=fe.PROFILE.threshold)
+    gallery.reload()
+    return gallery, normalise([row[3] for row in rows])
+
+
+def percentiles(seconds):
+    if not seconds:
+        return None
+    ms = np.asarray(seconds) * 1000.0
+    return {
+        "count": len(ms),
+        "mean": round(float(ms.mean()), 3),
+        "p50": round(float(np.percentile(ms, 50)), 3),
+        "p95": round(float(np.percentile(ms, 95)), 3),
+        "p99": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+class Replay:
+    """
+    Feeds bursts into a RecognitionPipeline with at most `concurrency`
+    bursts in flight and collects their decisions and stage timings.
+    """
+
+    def __init__(self, gallery, recognizer, embed, concurrency, burst_size, timeout):
+        self.timeout = timeout
+        self.stages = defaultdict(list)
+        self.decisions = {}  # burst index -> Decision
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Condition()
+        self.pipeline = RecognitionPipeline(gallery, self._on_decision, recognizer, embed=embed,
+                                            on_frame=self._on_frame,
+                                            max_frames=max(BURST_MAX_FRAMES, 2 * concurrency * burst_size))
+
+    def _on_frame(self, result, match_seconds):
+        with self._lock:
+            for stage, seconds in result.timings.items():
+                self.stages[stage].append(seconds)
+            self.stages["match"].append(match_seconds)
+
+    def _on_decision(self, camera_id, decision):
+        with self._lock:
+            self.decisions[int(camera_id)] = decision
+            self._lock.notify_all()
+        self._slots.release()
+
+    def run(self, bursts):
+        """
+        Replays every burst and returns the wall time in seconds.
+        """
+        start = time.perf_counter()
+        for i, (_, frames) in enumerate(bursts):
+            # Bursts evicted from a full assembler never release their slot
+            self._slots.acquire(timeout=self.timeout)
+            for seq, frame in enumerate(frames):
+                self.pipeline.submit(FrameHeader(str(i), str(i), seq, len(frames)), frame)
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            while len(self.decisions) < len(bursts) and time.monotonic() < deadline:
+                self._lock.wait(0.1)
+        return time.perf_counter() - start
+
+
+def report(bursts, replay, wall, dropped):
+    decided = replay.decisions
+    genuine = [i for i, (expected, _) in enumerate(bursts) if expected is not None]
+    impostors = [i for i, (expected, _) in enumerate(bursts) if expected is None]
+
+    def accepted(i):
+        match = decided[i].match if i in decided else None
+        return match if match and match.verified else None
+
+    true_accepts = sum(1 for i in genuine if accepted(i) and accepted(i).user_id == bursts[i][0])
+    misidentified = sum(1 for i in genuine if accepted(i) and accepted(i).user_id != bursts[i][0])
+    false_accepts = sum(1 for i in impostors if accepted(i))
+    stages = {stage: percentiles(seconds) for stage, seconds in sorted(replay.stages.items())}
+    stages["end_to_end"] = percentiles([d.elapsed for d in decided.values()])
+    frames = sum(len(frames) for _, frames in bursts)
+    return {
+        "bursts": len(bursts),
+        "decided": len(decided),
+        "early": sum(1 for d in decided.values() if d.early),
+        "dropped_frames": dropped,
+        "latency_ms": stages,
+        "wall_seconds": round(wall, 3),
+        "throughput": {
+            "bursts_per_second": round(len(decided) / wall, 2) if wall else None,
+            "frames_per_second": round(frames / wall, 2) if wall else None,
+        },
+        "genuine": len(genuine),
+        "impostors": len(impostors),
+        "tar": round(true_accepts / len(genuine), 4) if genuine else None,
+        "far": round(false_accepts / len(impostors), 4) if impostors else None,
+        "misidentified": misidentified,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recognition pipeline offline and print JSON results.")
+    parser.add_argument("--images", help="directory with one sub-directory of images per person (default: synthetic)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000], help="gallery sizes")
+    parser.add_argument("--bursts", type=int, default=200, help="synthetic probe bursts per gallery size")
+    parser.add_argument("--burst-size", type=int, default=BURST_SIZE, help="frames per burst")
+    parser.add_argument("--impostor-ratio", type=float, default=0.5, help="share of impostor people / bursts")
+    parser.add_argument("--noise", type=float, default=0.6, help="synthetic probe noise relative to the embedding norm")
+    parser.add_argument("--dim", type=int, default=512, help="synthetic embedding size")
+    parser.add_argument("--index", choices=("flat", "ivf"), default="flat")
+    parser.add_argument("--dtype", choices=EMBEDDING_DTYPES, default=EMBEDDING_DTYPE, help="flat gallery storage type")
+    parser.add_argument("--executor", choices=("process", "thread"), default=RECOGNITION_EXECUTOR)
+    parser.add_argument("--workers", type=int, default=RECOGNITION_WORKERS)
+    parser.add_argument("--concurrency", type=int, default=1, help="bursts in flight")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a burst")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    recognizer = Recognizer(workers=args.workers,
+                            queue_size=max(RECOGNITION_QUEUE_SIZE, args.concurrency * args.burst_size),
+                            kind=args.executor, initializer=_init_worker if args.images else None)
+    # Fork the workers before this process loads the model, as the app does
+    recognizer.start()
+    if args.images:
+        engine.load()
+        rows, bursts = image_dataset(args.images, args.impostor_ratio, args.burst_size, rng)
+        if not rows:
+            parser.error("no person could be enrolled from --images")
+        dim = len(rows[0][3])
+        embed = embed_frame
+    else:
+        rows, bursts, dim, embed = [], None, args.dim, synthetic_frame
+    deadline = time.monotonic() + args.timeout
+    while not recognizer.ready and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    results = []
+    for size in args.sizes:
+        start = time.perf_counter()
+        gallery, vectors = build_gallery(rows, size, dim, args.index, args.dtype, rng)
+        build_seconds = time.perf_counter() - start
+        if not args.images:
+            bursts = synthetic_bursts(vectors, args.bursts, args.impostor_ratio, args.burst_size, args.noise, rng)
+        replay = Replay(gallery, recognizer, embed, args.concurrency, args.burst_size, args.timeout)
+        dropped = recognizer.dropped
+        wall = replay.run(bursts)
+        result = {"gallery_size": len(gallery), "build_seconds": round(build_seconds, 3)}
+        result.update(report(bursts, replay, wall, recognizer.dropped - dropped))
+        results.append(result)
+        print(f"Gallery of {len(gallery)}: {result['decided']}/{result['bursts']} bursts decided "
+              f"in {wall:.2f}s", file=sys.stderr, flush=True)
+    recognizer.shutdown()
+
+    output = json.dumps({
+        "source": "images" if args.images else "synthetic",
+        "profile": fe.PROFILE.name if args.images else None,
+        "model": fe.MODEL_NAME if args.images else None,
+        "model_version": fe.MODEL_VERSION if args.images else None,
+        "detector": fe.DETECTOR_BACKEND if args.images else None,
+        "metric": gallery.metric,
+        "threshold": gallery.threshold,
+        "index": args.index,
+        "dtype": args.dtype if args.index == "flat" else "float32",
+        "executor": recognizer.kind,
+        "workers": recognizer.workers,
+        "burst_size": args.burst_size,
+        "concurrency": args.concurrency,
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+
+###############################################################################
+# Burst-level recognition decision
+###############################################################################
+# Frames of a burst are scored against the gallery as soon as they are
+# embedded. A single frame that is a very confident match decides the burst
+# at once (the remaining frames are skipped); otherwise the per-user
+# distances of all frames are fused before deciding, so one blurry frame
+# does not cause a false reject.
+FUSION_MODE = os.getenv("FACE_FUSION", "mean")  # "mean" or "max" (best frame) similarity per user
+# Early accept needs distance <= ratio * gallery threshold (or the absolute
+# FACE_EARLY_ACCEPT_DISTANCE) and at least this margin to the next user
+EARLY_ACCEPT_RATIO = 0.6
+EARLY_ACCEPT_DISTANCE = os.getenv("FACE_EARLY_ACCEPT_DISTANCE")
+EARLY_ACCEPT_MARGIN = float(os.getenv("FACE_EARLY_ACCEPT_MARGIN", "0.05"))
+
+# match is None when no frame could be embedded; image_data is the frame to
+# keep for an unknown-person log and embedding the probe of the best frame;
+# elapsed is the time in seconds from the burst's first frame to the decision
+Decision = namedtuple("Decision", ["match", "frames", "early", "image_data", "embedding", "elapsed"])
+
+
+class BurstDecision:
+    """
+    Decision state of one burst. Thread-safe: frames may be added from
+    several worker callbacks while the burst is being finished.
+    """
+
+    def __init__(self, gallery, fusion=FUSION_MODE):
+        if fusion not in ("mean", "max"):
+            raise ValueError(f"Unsupported fusion mode: {fusion}")
+        self.gallery = gallery
+        self.fusion = fusion
+        if EARLY_ACCEPT_DISTANCE is not None:
+            self.early_accept_distance = float(EARLY_ACCEPT_DISTANCE)
+        else:
+            self.early_accept_distance = EARLY_ACCEPT_RATIO * gallery.threshold
+        self.decided = False
+        self.started = time.monotonic()
+        self.futures = []
+        self._frames = []  # (user distances, floor, weight)
+        self._snapshot = (-1.0, None)  # (quality score, image_data) of the best frame so far
+        self._probe = (-1.0, None)  # (quality score, embedding) of the best embedded frame
+        self._lock = threading.Lock()
+
+    def track(self, future):
+        with self._lock:
+            self.futures.append(future)
+
+    def cancel_pending(self):
+        for future in self.futures:
+            future.cancel()
+
+    def abandon(self):
+        """
+        Marks the burst as decided without a decision (e.g. when dropped).
+        """
+        with self._lock:
+            self.decided = True
+        self.cancel_pending()
+
+    def add_frame(self, embedding, image_data, weight=1.0):
+        """
+        Scores one embedded frame (embedding None if it was rejected or no
+        face was found); `weight` is its quality score. Returns a Decision if
+        this frame decides the burst early, else None.
+        """
+        with self._lock:
+            if self.decided:
+                return None
+            if weight >= self._snapshot[0]:
+                self._snapshot = (weight, image_data)
+            if embedding is None:
+                return None
+            if weight >= self._probe[0]:
+                self._probe = (weight, embedding)
+            distances, floor = self.gallery.user_distances(embedding)
+            self._frames.append((distances, floor, max(weight, 1e-3)))
+            match = self.gallery.best_match(distances, floor)
+            if match and match.distance <= self.early_accept_distance and match.margin >= EARLY_ACCEPT_MARGIN:
+                self.decided = True
+                return Decision(match, len(self._frames), True, image_data, embedding, self._elapsed())
+        return None
+
+    def finish(self):
+        """
+        Fuses every embedded frame and returns the final Decision, or None
+        if the burst was already decided early.
+        """
+        with self._lock:
+            if self.decided:
+                return None
+            self.decided = True
+            if not self._frames:
+                return Decision(None, 0, False, self._snapshot[1], None, self._elapsed())
+            match = self.gallery.best_match(self._fuse(), min(floor for _, floor, _ in self._frames))
+            return Decision(match, len(self._frames), False, self._snapshot[1], self._probe[1], self._elapsed())
+
+    def _elapsed(self):
+        return time.monotonic() - self.started
+
+    def _fuse(self):
+        """
+        Returns {user_id: (distance, face_identity_id, name)} combining all
+        frames, weighting each frame by its quality score. A user missing
+        from a frame's candidates is counted at that frame's floor distance
+        (a lower bound on the real one).
+        """
+        users = {}
+        for distances, _, _ in self._frames:
+            for user_id, (_, face_identity_id, name) in distances.items():
+                users.setdefault(user_id, (face_identity_id, name))
+        fused = {}
+        for user_id, (face_identity_id, name) in users.items():
+            per_frame, weights = [], []
+            for distances, floor, weight in self._frames:
+                if user_id in distances:
+                    per_frame.append(distances[user_id][0])
+                elif np.isfinite(floor):
+                    per_frame.append(floor)
+                else:
+                    continue
+                weights.append(weight)
+            if self.fusion == "mean":
+                distance = float(np.average(per_frame, weights=weights))
+            else:
+                distance = float(np.min(per_frame))
+            fused[user_id] = (distance, face_identity_id, name)
+        return fused
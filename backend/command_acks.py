@@ -0,0 +1,171 @@
+import os
+import bisect
+import threading
+import time
+
+###############################################################################
+# Command acknowledgement
+###############################################################################
+# A door or light reports its new state on the feed it was commanded on. A
+# command is acknowledged by the first report of the commanded value after it
+# was published, and timed out if none arrives within ACK_TIMEOUT. The broker
+# also echoes the backend's own publish back on the feed, so one report per
+# publish is consumed as its echo first.
+ACK_TIMEOUT = float(os.getenv("COMMAND_ACK_TIMEOUT", "10"))  # seconds
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _normalise(payload):
+    return str(payload).strip().upper()
+
+
+class LatencyHistogram:
+    """
+    Counts latencies into LATENCY_BUCKETS_MS buckets; percentiles are the
+    upper bound of the bucket they fall in.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last bucket: over the largest bound
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank, seen = q / 100.0 * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f"gt_{self.bounds[-1]}"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 1) if self.count else None,
+            "min": round(self.min, 1) if self.min is not None else None,
+            "max": round(self.max, 1) if self.max is not None else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": buckets,
+        }
+
+
+class AckTracker:
+    """
+    Correlates device feedback with published commands. `feeds` maps each
+    tracked feed to its device type. Once started, `on_result(ref, status,
+    latency_seconds)` is called with "acknowledged" or "timed_out" for every
+    command published with a `ref`.
+    """
+
+    def __init__(self, feeds, timeout=ACK_TIMEOUT):
+        self.feeds = feeds
+        self.timeout = timeout
+        self.on_result = None
+        self._pending = {}  # ref -> (device type, feed, payload, published at)
+        self._echoes = []  # (feed, payload, expires at) of own publishes not seen back yet
+        self._latency = {}  # device type -> LatencyHistogram
+        self._counts = {}  # device type -> {"acknowledged": n, "timed_out": n}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._sweeper = None
+
+    def start(self, on_result):
+        with self._lock:
+            self.on_result = on_result
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="command-acks", daemon=True)
+                self._sweeper.start()
+
+    def publishing(self, feed, payload, ref=None):
+        """
+        Called just before a command is published, so that its echo cannot
+        arrive first.
+        """
+        if feed not in self.feeds:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._echoes.append((feed, _normalise(payload), now + self.timeout))
+            if ref is not None:
+                self._pending[ref] = (self.feeds[feed], feed, _normalise(payload), now)
+
+    def cancel(self, ref):
+        with self._lock:
+            self._pending.pop(ref, None)
+
+    def feedback(self, feed, payload):
+        """
+        Handles a state reported on a tracked feed.
+        """
+        if feed not in self.feeds:
+            return
+        value = _normalise(payload)
+        now = time.monotonic()
+        with self._lock:
+            self._echoes = [echo for echo in self._echoes if echo[2] > now]
+            for i, (echo_feed, echo_value, _) in enumerate(self._echoes):
+                if echo_feed == feed and echo_value == value:
+                    del self._echoes[i]
+                    return
+            # The oldest command still waiting for this value
+            waiting = [(published, ref) for ref, (_, pending_feed, pending_value, published) in self._pending.items()
+                       if pending_feed == feed and pending_value == value]
+            if not waiting:
+                return
+            published, ref = min(waiting, key=lambda item: item[0])
+            device_type = self._pending.pop(ref)[0]
+            latency = now - published
+            self._latency.setdefault(device_type, LatencyHistogram()).add(latency * 1000.0)
+            self._count(device_type, "acknowledged")
+        self._report(ref, "acknowledged", latency)
+
+    def _count(self, device_type, status):
+        counts = self._counts.setdefault(device_type, {"acknowledged": 0, "timed_out": 0})
+        counts[status] += 1
+
+    def _report(self, ref, status, latency):
+        if self.on_result is None:
+            return
+        try:
+            self.on_result(ref, status, latency)
+        except Exception as e:
+            print("Error recording command acknowledgement:", e)
+
+    def _sweep_loop(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait(self.timeout / 4)
+                now = time.monotonic()
+                expired = [ref for ref, pending in self._pending.items() if now - pending[3] >= self.timeout]
+                for ref in expired:
+                    device_type = self._pending.pop(ref)[0]
+                    self._count(device_type, "timed_out")
+            for ref in expired:
+                print(f"Command {ref} was not acknowledged within {self.timeout:.0f}s")
+                self._report(ref, "timed_out", None)
+
+    def status(self):
+        with self._lock:
+            device_types = set(self.feeds.values())
+            return {device_type: dict(
+                self._counts.get(device_type, {"acknowledged": 0, "timed_out": 0}),
+                pending=sum(1 for pending in self._pending.values() if pending[0] == device_type),
+                latency_ms=(self._latency[device_type] if device_type in self._latency
+                            else LatencyHistogram()).summary(),
+            ) for device_type in sorted(device_types)}
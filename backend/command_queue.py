@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+###############################################################################
+# Outbound command queue
+###############################################################################
+# Device commands are published by one background sender instead of inside
+# the HTTP request, so a slow or throttled broker never stalls a worker.
+# Adafruit IO throttles bursts (30 data points a minute on a free account):
+# a token bucket keeps the sender under the limit, and a command still queued
+# when a newer one for the same feed arrives within COALESCE_WINDOW is
+# superseded, only the newest state being sent.
+PUBLISH_RATE = float(os.getenv("PUBLISH_RATE", "0.4"))  # commands per second, 0 = unlimited
+PUBLISH_BURST = int(os.getenv("PUBLISH_BURST", "6"))
+COALESCE_WINDOW = float(os.getenv("PUBLISH_COALESCE_WINDOW", "1"))  # seconds
+PUBLISH_TIMEOUT = float(os.getenv("PUBLISH_TIMEOUT", "30"))  # seconds a command may wait for the broker
+PUBLISH_RETRY_DELAY = 1
+COMMAND_QUEUE_SIZE = 256
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Allows `burst` operations at once, refilled at `rate` per second.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """
+        Takes a token and returns 0, or returns the seconds until one is available.
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class _Command:
+    def __init__(self, feed, payload, ref):
+        self.id = uuid.uuid4().hex
+        self.feed = feed
+        self.payload = payload
+        self.ref = ref
+        self.queued_at = time.monotonic()
+        self.sending = False
+
+
+class CommandQueue:
+    """
+    Publishes commands through `connection` (adafruit_io_client.Connection)
+    in submission order. `on_outcome(ref, status, error)` is called from the
+    sender thread once the fate of every command submitted with a `ref` is
+    known: "sent", "failed" or "superseded". `on_publish(feed, payload, ref)`
+    is called just before a command is first handed to the broker.
+    """
+
+    def __init__(self, connection, on_outcome=None, rate=PUBLISH_RATE, burst=PUBLISH_BURST,
+                 coalesce_window=COALESCE_WINDOW, timeout=PUBLISH_TIMEOUT, max_size=COMMAND_QUEUE_SIZE,
+                 on_publish=None):
+        self.connection = connection
+        self.on_outcome = on_outcome
+        self.on_publish = on_publish
+        self.bucket = TokenBucket(rate, burst)
+        self.coalesce_window = coalesce_window
+        self.timeout = timeout
+        self.max_size = max_size
+        self.counts = {"sent": 0, "failed": 0, "superseded": 0}
+        self._queue = OrderedDict()  # command id -> _Command, oldest first
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._sender = None
+
+    def submit(self, feed, payload, ref=None):
+        """
+        Queues a command and returns at once. Raises QueueFull when the
+        broker has fallen too far behind.
+        """
+        command = _Command(feed, payload, ref)
+        superseded = None
+        with self._lock:
+            for queued in self._queue.values():
+                if (queued.feed == feed and not queued.sending
+                        and command.queued_at - queued.queued_at <= self.coalesce_window):
+                    # Send the newest state in the superseded command's place in line
+                    superseded = _Command(queued.feed, queued.payload, queued.ref)
+                    queued.payload, queued.ref = payload, ref
+                    self.counts["superseded"] += 1
+                    break
+            else:
+                if len(self._queue) >= self.max_size:
+                    raise QueueFull(f"{len(self._queue)} commands waiting")
+                self._queue[command.id] = command
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._run, name="command-sender", daemon=True)
+                self._sender.start()
+            self._wakeup.notify()
+        if superseded is not None:
+            print(f"Command {superseded.payload} to {feed} superseded by {payload}")
+            self._report(superseded, "superseded")
+
+    def _report(self, command, status, error=None):
+        if self.on_outcome and command.ref is not None:
+            try:
+                self.on_outcome(command.ref, status, error)
+            except Exception as e:
+                print("Error recording command outcome:", e)
+
+    def _next(self):
+        # Blocks until a command may be sent and returns it, still queued but no longer coalesced
+        with self._lock:
+            while True:
+                while not self._queue:
+                    self._wakeup.wait()
+                delay = self.bucket.delay()
+                if delay <= 0:
+                    command = next(iter(self._queue.values()))
+                    command.sending = True
+                    return command
+                # Commands arriving meanwhile may still be coalesced into the queue
+                self._wakeup.wait(delay)
+
+    def _run(self):
+        while True:
+            command = self._next()
+            feed, payload = command.feed, command.payload
+            if self.on_publish:
+                self.on_publish(feed, payload, command.ref)
+            while True:
+                try:
+                    self.connection.publish(feed, payload)
+                    error = None
+                    break
+                except Exception as e:
+                    error = str(e)
+                if time.monotonic() - command.queued_at >= self.timeout:
+                    break
+                time.sleep(PUBLISH_RETRY_DELAY)
+            with self._lock:
+                self._queue.pop(command.id, None)
+                status = "failed" if error else "sent"
+                self.counts[status] += 1
+            if error:
+                print(f"Failed to send {payload} to {feed}:", error)
+            else:
+                print(f"Published to {feed}: {payload}")
+            self._report(command, status, error)
+
+    def status(self):
+        with self._lock:
+            return dict(self.counts, queued=len(self._queue))
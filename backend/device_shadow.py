@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+
+###############################################################################
+# Device state shadow
+###############################################################################
+# The last state reported on each device feed, kept in memory so the API can
+# answer "is the door open?" without touching MQTT or the control history.
+# Every change gets the next shadow-wide version, so a client can poll for
+# only what changed since the version it last saw. Changed states are written
+# back to the database every PERSIST_INTERVAL seconds by a background thread.
+PERSIST_INTERVAL = float(os.getenv("DEVICE_STATE_PERSIST_INTERVAL", "10"))
+
+
+class DeviceShadow:
+    def __init__(self):
+        self.version = 0
+        self.persisted_at = None
+        self._devices = {}  # device -> state dict
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._persister = None
+
+    def report(self, device, value):
+        """
+        Records a state reported on a device's feed. Returns True if it
+        changed the shadow.
+        """
+        now = time.time()
+        with self._lock:
+            state = self._devices.get(device)
+            if state is not None and state["value"] == value:
+                state["reported_at"] = now
+                return False
+            self.version += 1
+            self._devices[device] = {"value": value, "version": self.version, "updated_at": now, "reported_at": now}
+            self._dirty.add(device)
+            return True
+
+    def snapshot(self, since=0):
+        """
+        Returns the shadow version and copies of the device states changed
+        after version `since`.
+        """
+        with self._lock:
+            return self.version, {device: dict(state) for device, state in self._devices.items()
+                                  if state["version"] > since}
+
+    def start(self, persist, interval=PERSIST_INTERVAL):
+        """
+        Calls `persist({device: value})` with the states changed since the
+        previous call every `interval` seconds, from a background thread.
+        """
+        with self._lock:
+            if self._persister is None:
+                self._persister = threading.Thread(target=self._persist_loop, args=(persist, interval),
+                                                   name="device-shadow", daemon=True)
+                self._persister.start()
+
+    def flush(self, persist):
+        with self._lock:
+            dirty = {device: self._devices[device]["value"] for device in self._dirty}
+            self._dirty.clear()
+        if not dirty:
+            return
+        try:
+            persist(dirty)
+            self.persisted_at = time.time()
+        except Exception as e:
+            print("Error persisting device states:", e)
+            with self._lock:
+                self._dirty.update(dirty)
+
+    def _persist_loop(self, persist, interval):
+        while True:
+            time.sleep(interval)
+            self.flush(persist)
@@ -0,0 +1,145 @@
+import os
+from collections import namedtuple
+import cv2
+import numpy as np
+import deepface
+from deepface import DeepFace
+from face_gallery import EMBEDDING_DTYPE, quantize, dequantize
+
+###############################################################################
+# Face embedding helpers
+###############################################################################
+# Embeddings are computed once per enrolled image and stored in the
+# face_embedding table, so a door event only has to embed the probe frame.
+MODEL_VERSION = getattr(deepface, "__version__", "unknown")
+
+# A recognition profile picks the model, the face detector, the width frames
+# are downscaled to before detection, and the match threshold (None: the
+# model's default for the metric, see face_gallery.MODEL_THRESHOLDS).
+# RECOGNITION_THRESHOLD is the one threshold override, a distance in
+# FACE_MATCH_METRIC units applied to every gallery of the running profile.
+# Detectors, faster on CPU: "opencv" (Haar), "ssd", "yunet"; more accurate:
+# "retinaface", "mtcnn". "skip" treats the frame as the face.
+Profile = namedtuple("Profile", ["name", "model_name", "detector_backend", "input_width", "threshold"])
+PROFILES = {
+    "accurate": Profile("accurate", "Facenet512", "opencv", 640, None),
+    "balanced": Profile("balanced", "Facenet", "opencv", 480, None),
+    # For low-power door hosts: small model, fast detector, small frames
+    "fast": Profile("fast", "SFace", "yunet", 320, None),
+}
+
+
+def get_profile(name=None):
+    """
+    Returns the named profile (default: RECOGNITION_PROFILE) with the
+    FACE_MODEL_NAME, FACE_DETECTOR_BACKEND, FACE_INPUT_WIDTH and
+    RECOGNITION_THRESHOLD overrides applied.
+    """
+    name = name or os.getenv("RECOGNITION_PROFILE", "accurate")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown recognition profile: {name}")
+    profile = PROFILES[name]
+    threshold = os.getenv("RECOGNITION_THRESHOLD")
+    return profile._replace(
+        model_name=os.getenv("FACE_MODEL_NAME", profile.model_name),
+        detector_backend=os.getenv("FACE_DETECTOR_BACKEND", profile.detector_backend),
+        input_width=int(os.getenv("FACE_INPUT_WIDTH", profile.input_width)),
+        threshold=float(threshold) if threshold else profile.threshold,
+    )
+
+
+PROFILE = get_profile()
+MODEL_NAME = PROFILE.model_name
+DETECTOR_BACKEND = PROFILE.detector_backend
+
+# crop is the aligned face as a BGR uint8 array, area the facial_area dict
+Face = namedtuple("Face", ["crop", "area", "confidence"])
+
+
+def decode_image(image_data):
+    """
+    Decodes raw JPEG/PNG bytes into a BGR numpy array (None if undecodable).
+    """
+    if not image_data:
+        return None
+    return cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_jpeg(image, quality=90):
+    ok, buffer = cv2.imencode(".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return buffer.tobytes() if ok else None
+
+
+def detect_faces(img, detector_backend=None, max_width=None):
+    """
+    Detects and aligns every face of `img` (a file path or a BGR numpy
+    array) once. Returns a list of Face, empty if no face was found.
+    Wider images are downscaled to `max_width` first; facial areas are
+    still reported in the original image's pixels.
+    """
+    if isinstance(img, str):
+        img = cv2.imread(img)
+    scale = 1.0
+    if max_width and img.shape[1] > max_width:
+        scale = max_width / img.shape[1]
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    try:
+        faces = DeepFace.extract_faces(img, detector_backend=detector_backend or DETECTOR_BACKEND,
+                                       align=True, enforce_detection=True)
+    except ValueError:
+        return []
+    # extract_faces returns RGB floats in [0, 1]
+    return [Face(np.ascontiguousarray((f["face"][:, :, ::-1] * 255).clip(0, 255).astype(np.uint8)),
+                 {k: int(round(v / scale)) if k in ("x", "y", "w", "h") else v
+                  for k, v in f["facial_area"].items()},
+                 f.get("confidence"))
+            for f in faces]
+
+
+def largest_face(faces):
+    return max(faces, key=lambda f: f.area["w"] * f.area["h"])
+
+
+def embed_face(crop, model_name=None):
+    """
+    Embeds an already detected and aligned face crop.
+    """
+    result = DeepFace.represent(crop, model_name=model_name or MODEL_NAME, detector_backend="skip")
+    return np.asarray(result[0]["embedding"], dtype=np.float32)
+
+
+def compute_embedding(img, enforce_detection=True, profile=None):
+    """
+    Returns the float32 embedding of the largest face in `img`
+    (a file path or a BGR numpy array) with the given profile's model and
+    detector (default: PROFILE).
+    """
+    profile = profile or PROFILE
+    if isinstance(img, str):
+        img = cv2.imread(img)
+    faces = detect_faces(img, profile.detector_backend, profile.input_width)
+    if faces:
+        return embed_face(largest_face(faces).crop, profile.model_name)
+    if enforce_detection:
+        raise ValueError("Face could not be detected")
+    return embed_face(img, profile.model_name)
+
+
+def embedding_to_blob(embedding, dtype=EMBEDDING_DTYPE):
+    """
+    Packs an embedding as `dtype`; int8 blobs start with their float32 scale.
+    """
+    values, scales = quantize(embedding, dtype)
+    if dtype == "int8":
+        return scales.tobytes() + values.tobytes()
+    return values.tobytes()
+
+
+def blob_to_embedding(blob, dtype="float32"):
+    """
+    Unpacks a blob written by embedding_to_blob() into a float32 embedding.
+    """
+    if dtype == "int8":
+        scales = np.frombuffer(blob[:4], dtype=np.float32)
+        return dequantize(np.frombuffer(blob[4:], dtype=np.int8)[None], scales)[0]
+    return np.frombuffer(blob, dtype=dtype).astype(np.float32)
@@ -0,0 +1,440 @@
+import os
+import argparse
+import json
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+
+###############################################################################
+# In-memory face gallery
+###############################################################################
+# All enrolled embeddings are kept L2-normalised so a probe is scored with
+# dot products. On normalised vectors cosine and euclidean distance rank
+# identically; the metric only changes how distances are reported.
+MATCH_METRIC = os.getenv("FACE_MATCH_METRIC", "cosine")  # "cosine" or "euclidean_l2"
+
+# DeepFace's thresholds per model and metric
+MODEL_THRESHOLDS = {
+    "Facenet512": {"cosine": 0.30, "euclidean_l2": 1.04},
+    "Facenet": {"cosine": 0.40, "euclidean_l2": 0.80},
+    "SFace": {"cosine": 0.593, "euclidean_l2": 1.055},
+    "ArcFace": {"cosine": 0.68, "euclidean_l2": 1.13},
+    "VGG-Face": {"cosine": 0.68, "euclidean_l2": 1.17},
+}
+DEFAULT_THRESHOLDS = MODEL_THRESHOLDS["Facenet512"]
+
+# Number of nearest faces fetched per probe; the margin is taken from them
+MATCH_CANDIDATES = int(os.getenv("FACE_MATCH_CANDIDATES", "32"))
+
+# Element type of the gallery matrix and of stored embedding blobs: "float32",
+# "float16" or "int8" (symmetric, one float32 scale per vector). float16 only
+# halves the stored blobs: numpy has no fast float16 matrix product, so those
+# vectors are expanded to float32 once as they enter the index. int8
+# galleries are scanned with the probe quantized the same way, then the best
+# RERANK_FACTOR * k candidates are re-scored with the float32 probe.
+EMBEDDING_DTYPE = os.getenv("FACE_EMBEDDING_DTYPE", "float32")
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+RERANK_FACTOR = 4
+# Rows converted at a time while scanning an int8 matrix (fits in cache)
+SCAN_CHUNK = 256
+
+Match = namedtuple("Match", ["face_identity_id", "user_id", "name", "distance", "margin", "verified"])
+
+
+def normalise(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors, dtype):
+    """
+    Returns (values, scales) of float vectors (one per row) stored as
+    `dtype`; scales are 1 except for int8.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        values = np.rint(vectors / scales[:, None]).clip(-127, 127).astype(np.int8)
+        return values, scales.astype(np.float32)
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    return vectors.astype(dtype), np.ones(len(vectors), dtype=np.float32)
+
+
+def dequantize(values, scales):
+    return np.asarray(values, dtype=np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+
+
+def top_k(keys, similarities, k):
+    """
+    Returns the `k` highest scoring (keys, similarities), best first.
+    """
+    if len(similarities) > k:
+        best = np.argpartition(similarities, -k)[-k:]
+        keys, similarities = keys[best], similarities[best]
+    order = np.argsort(-similarities)
+    return keys[order], similarities[order]
+
+
+class FlatIndex:
+    """
+    Exact index: one contiguous matrix scanned with a single matrix-vector
+    product per probe. With int8 the matrix is scanned in chunks and the
+    best candidates are re-ranked in float32; float16 vectors keep their
+    rounding but are held as float32.
+    """
+
+    def __init__(self, dtype=EMBEDDING_DTYPE):
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {dtype}")
+        self.dtype = dtype
+        self._matrix_dtype = np.int8 if dtype == "int8" else np.float32
+        self.clear()
+
+    def clear(self):
+        self._size = 0
+        self._matrix = np.zeros((0, 0), dtype=self._matrix_dtype)
+        self._scales = np.zeros(0, dtype=np.float32)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._rows = {}  # key -> row index
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the vectors (including unused capacity).
+        """
+        return self._matrix.nbytes + (self._scales.nbytes if self.dtype == "int8" else 0)
+
+    def sync(self, keys, vectors):
+        """
+        Replaces the index content with the given normalised vectors.
+        """
+        self.clear()
+        for key, vector in zip(keys, vectors):
+            self.add(key, vector)
+
+    def _grow(self, dim):
+        capacity = max(16, 2 * len(self._keys))
+        if self._matrix.shape[1] != dim:
+            if self._size:
+                raise ValueError(f"Embedding size {dim} does not match gallery size {self._matrix.shape[1]}")
+            self._matrix = np.zeros((0, dim), dtype=self._matrix_dtype)
+        matrix = np.zeros((capacity, dim), dtype=self._matrix_dtype)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+        self._scales = np.resize(self._scales, capacity)
+        self._keys = np.resize(self._keys, capacity)
+
+    def add(self, key, vector):
+        row = self._rows.get(key)
+        if row is None:
+            if self._size == len(self._keys) or self._matrix.shape[1] != vector.shape[0]:
+                self._grow(vector.shape[0])
+            row = self._size
+            self._size += 1
+            self._rows[key] = row
+        values, scales = quantize(vector, self.dtype)
+        self._matrix[row] = values[0]
+        self._scales[row] = scales[0]
+        self._keys[row] = key
+
+    def remove(self, key):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        last = self._size - 1
+        if row != last:
+            # Move the last row into the hole to keep the matrix contiguous
+            self._matrix[row] = self._matrix[last]
+            self._scales[row] = self._scales[last]
+            self._keys[row] = self._keys[last]
+            self._rows[int(self._keys[row])] = row
+        self._size = last
+
+    def search(self, probe, k):
+        if not self._size:
+            return self._keys[:0], np.zeros(0, dtype=np.float32)
+        if self.dtype != "int8":
+            similarities = self._matrix[:self._size] @ probe
+            return top_k(self._keys[:self._size], similarities, k)
+        # Score in the compact domain: int8 x int8 dot products are exact in float32
+        values, scales = quantize(probe, self.dtype)
+        compact_probe = values[0].astype(np.float32)
+        similarities = np.empty(self._size, dtype=np.float32)
+        for start in range(0, self._size, SCAN_CHUNK):
+            end = min(start + SCAN_CHUNK, self._size)
+            similarities[start:end] = self._matrix[start:end].astype(np.float32) @ compact_probe
+        similarities *= self._scales[:self._size] * scales[0]
+        rows, _ = top_k(np.arange(self._size), similarities, min(self._size, RERANK_FACTOR * k))
+        # Re-rank the candidates with the float32 probe
+        candidates = dequantize(self._matrix[rows], self._scales[rows]) @ probe
+        return top_k(self._keys[rows], candidates, k)
+
+
+class FaceGallery:
+    """
+    Gallery of face embeddings backed by a FlatIndex (exact scan) or an
+    ann_index.IVFIndex (approximate).
+
+    `loader` is called lazily on first use and must return an iterable of
+    (face_identity_id, user_id, name, embedding) tuples. `model_name` picks
+    the default threshold.
+    """
+
+    def __init__(self, loader, metric=MATCH_METRIC, threshold=None, index=None, model_name=None):
+        if metric not in DEFAULT_THRESHOLDS:
+            raise ValueError(f"Unsupported match metric: {metric}")
+        self.metric = metric
+        if threshold is None:
+            thresholds = MODEL_THRESHOLDS.get(model_name, DEFAULT_THRESHOLDS)
+            threshold = thresholds[metric]
+        self.threshold = threshold
+        self.index = index if index is not None else FlatIndex()
+        self._loader = loader
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._identities = {}  # face_identity_id -> (user_id, name)
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._identities)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.reload()
+
+    def reload(self):
+        """
+        Rebuilds the gallery from the loader.
+        """
+        with self._lock:
+            # Loading under the lock so an upsert made meanwhile is not lost
+            rows = list(self._loader())
+            self._identities = {row[0]: (row[1], row[2]) for row in rows}
+            self.index.sync([row[0] for row in rows], [normalise(row[3]) for row in rows])
+            self._loaded = True
+
+    def upsert(self, face_identity_id, user_id, name, embedding):
+        """
+        Adds or replaces one identity. Ignored until the gallery is loaded,
+        since the loader will pick the change up from the database.
+        """
+        with self._lock:
+            if self._loaded:
+                self._identities[face_identity_id] = (user_id, name)
+                self.index.add(face_identity_id, normalise(embedding))
+
+    def remove(self, face_identity_id):
+        with self._lock:
+            if self._identities.pop(face_identity_id, None) is not None:
+                self.index.remove(face_identity_id)
+
+    def remove_user(self, user_id):
+        with self._lock:
+            for face_identity_id in [k for k, (uid, _) in self._identities.items() if uid == user_id]:
+                del self._identities[face_identity_id]
+                self.index.remove(face_identity_id)
+
+    def _to_distance(self, similarity):
+        if self.metric == "euclidean_l2":
+            return float(np.sqrt(max(2.0 - 2.0 * similarity, 0.0)))
+        return float(1.0 - similarity)
+
+    def user_distances(self, probe):
+        """
+        Returns ({user_id: (distance, face_identity_id, name)}, floor) for the
+        users among the nearest candidates of `probe`, keeping each user's
+        closest face. `floor` is the distance of the farthest candidate when
+        the candidate list was cut off (unlisted users are at least that far),
+        inf otherwise.
+        """
+        self._ensure_loaded()
+        probe = normalise(probe)
+        with self._lock:
+            keys, similarities = self.index.search(probe, MATCH_CANDIDATES)
+            distances = {}
+            for key, similarity in zip(keys, similarities):
+                user_id, name = self._identities[int(key)]
+                if user_id not in distances:
+                    distances[user_id] = (self._to_distance(similarity), int(key), name)
+            floor = self._to_distance(similarities[-1]) if len(keys) == MATCH_CANDIDATES else float("inf")
+            return distances, floor
+
+    def best_match(self, distances, floor=float("inf")):
+        """
+        Picks the closest user of a user_distances() result as a Match, or
+        None if it is empty. `margin` is the distance gap to the next user
+        (bounded by `floor`).
+        """
+        if not distances:
+            return None
+        ranked = sorted(distances.items(), key=lambda item: item[1][0])
+        user_id, (distance, face_identity_id, name) = ranked[0]
+        runner_up = min(ranked[1][1][0], floor) if len(ranked) > 1 else floor
+        return Match(
+            face_identity_id=face_identity_id,
+            user_id=user_id,
+            name=name,
+            distance=distance,
+            margin=runner_up - distance,
+            verified=distance <= self.threshold,
+        )
+
+    def match(self, probe):
+        """
+        Returns the best Match for `probe`, or None if the gallery is empty.
+        """
+        return self.best_match(*self.user_distances(probe))
+
+
+class GalleryPartitions:
+    """
+    One FaceGallery per partition key (e.g. a place), each holding only the
+    faces allowed there, so a probe is searched against fewer faces.
+    `loader(key)` returns the rows of a partition; galleries are created and
+    loaded on first use, and kept up to date with upsert() / remove_user().
+    """
+
+    def __init__(self, loader, **gallery_options):
+        self._loader = loader
+        self._options = gallery_options
+        self._galleries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            gallery = self._galleries.get(key)
+            if gallery is None:
+                gallery = self._galleries[key] = FaceGallery(lambda: self._loader(key), **self._options)
+            return gallery
+
+    def upsert(self, keys, face_identity_id, user_id, name, embedding):
+        """
+        Adds or replaces one face in the partitions `keys` and removes it
+        from every other partition.
+        """
+        with self._lock:
+            galleries = list(self._galleries.items())
+        for key, gallery in galleries:
+            if key in keys:
+                gallery.upsert(face_identity_id, user_id, name, embedding)
+            else:
+                gallery.remove(face_identity_id)
+
+    def remove(self, face_identity_id):
+        with self._lock:
+            galleries = list(self._galleries.values())
+        for gallery in galleries:
+            gallery.remove(face_identity_id)
+
+    def remove_user(self, user_id, keys=None):
+        """
+        Removes every face of `user_id` from the partitions `keys` (default: all).
+        """
+        with self._lock:
+            galleries = [g for key, g in self._galleries.items() if keys is None or key in keys]
+        for gallery in galleries:
+            gallery.remove_user(user_id)
+
+    def drop(self, key):
+        with self._lock:
+            self._galleries.pop(key, None)
+
+    def status(self):
+        with self._lock:
+            return {str(key): len(g.index) if g.loaded else None for key, g in self._galleries.items()}
+
+
+def quantization_report(vectors, queries, truth, dtypes=EMBEDDING_DTYPES, k=10,
+                        threshold=DEFAULT_THRESHOLDS["cosine"]):
+    """
+    Compares galleries of normalised `vectors` stored as each dtype against
+    the float32 one. `truth` is the gallery row each query was taken from, or
+    -1 for an impostor query. Returns one dict per dtype.
+    """
+    keys = np.arange(len(vectors))
+    exact = FlatIndex("float32")
+    exact.sync(keys, vectors)
+    reference = [exact.search(query, k) for query in queries]
+    rows = []
+    for dtype in dtypes:
+        index = FlatIndex(dtype)
+        index.sync(keys, vectors)
+        latencies, agreement, recall, error = [], 0, 0.0, 0.0
+        genuine = impostors = true_accepts = false_accepts = 0
+        for query, row, (expected, _) in zip(queries, truth, reference):
+            start = time.perf_counter()
+            found, similarities = index.search(query, k)
+            latencies.append(time.perf_counter() - start)
+            agreement += int(found[0] == expected[0])
+            recall += len(set(found.tolist()) & set(expected.tolist())) / len(expected)
+            error = max(error, abs(float(similarities[0]) - float(vectors[found[0]] @ query)))
+            accepted = 1.0 - similarities[0] <= threshold
+            if row >= 0:
+                genuine += 1
+                true_accepts += int(accepted and found[0] == row)
+            else:
+                impostors += 1
+                false_accepts += int(accepted)
+        vector_bytes = vectors.shape[1] * np.dtype(dtype).itemsize + (4 if dtype == "int8" else 0)
+        rows.append({
+            "dtype": dtype,
+            "gallery_size": len(vectors),
+            "bytes_per_vector": vector_bytes,
+            "stored_mb": round(len(vectors) * vector_bytes / 2 ** 20, 3),
+            "index_mb": round(index.nbytes / 2 ** 20, 3),  # as allocated, with spare capacity
+            "search_ms_p50": round(1000 * float(np.percentile(latencies, 50)), 3),
+            "search_ms_p95": round(1000 * float(np.percentile(latencies, 95)), 3),
+            "top1_agreement": round(agreement / len(queries), 4),
+            f"recall@{k}": round(recall / len(queries), 4),
+            "max_similarity_error": round(error, 6),
+            "tar": round(true_accepts / genuine, 4) if genuine else None,
+            "far": round(false_accepts / impostors, 4) if impostors else None,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report memory and accuracy of compact galleries against float32.")
+    parser.add_argument("--index", help="saved IVF index directory to take the gallery from (default: synthetic)")
+    parser.add_argument("--size", type=int, default=10000, help="synthetic gallery size")
+    parser.add_argument("--dim", type=int, default=512, help="synthetic embedding size")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.6, help="probe noise relative to the embedding norm")
+    parser.add_argument("--impostor-ratio", type=float, default=0.5)
+    parser.add_argument("--dtype", nargs="+", choices=EMBEDDING_DTYPES, default=list(EMBEDDING_DTYPES))
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.index:
+        from ann_index import IVFIndex
+        vectors = np.asarray(IVFIndex(args.index).items()[1])
+    else:
+        vectors = normalise(rng.normal(size=(args.size, args.dim)))
+    # Genuine probes are noisy copies of gallery faces, impostors random faces
+    truth = rng.choice(len(vectors), args.queries)
+    truth[rng.random(args.queries) < args.impostor_ratio] = -1
+    centers = np.where(truth[:, None] >= 0, vectors[truth], normalise(rng.normal(size=(args.queries, vectors.shape[1]))))
+    noise = rng.normal(size=centers.shape) * args.noise / np.sqrt(vectors.shape[1])
+    queries = normalise(centers + noise)
+
+    for row in quantization_report(vectors, queries, truth, args.dtype, k=args.k):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
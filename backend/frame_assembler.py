@@ -0,0 +1,161 @@
+import os
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+###############################################################################
+# Burst assembly for the picture feed
+###############################################################################
+# The camera sends a burst of frames per door event. Each frame is published
+# as a JSON envelope
+#     {"camera": "door-1", "burst": "<id>", "seq": 0, "count": 2, "image": "<base64>"}
+# A burst cut short sends its real frame count on its last frame, which
+# completes the burst early. Plain base64 payloads (older camera clients)
+# are accepted too; they are grouped per camera in arrival order using
+# BURST_SIZE.
+BURST_SIZE = int(os.getenv("BURST_SIZE", "2"))
+# Seconds after the last frame before an incomplete burst is flushed
+BURST_TIMEOUT = float(os.getenv("BURST_TIMEOUT", "5"))
+# Frames held across all open bursts; the oldest burst is dropped beyond this
+BURST_MAX_FRAMES = int(os.getenv("BURST_MAX_FRAMES", "32"))
+DEFAULT_CAMERA = "default"
+
+FrameHeader = namedtuple("FrameHeader", ["camera_id", "burst_id", "seq", "count"])
+Burst = namedtuple("Burst", ["camera_id", "burst_id", "items", "complete", "state"])
+
+
+def parse_frame(payload):
+    """
+    Splits a picture feed payload into (FrameHeader, base64 image).
+    """
+    if payload.lstrip().startswith("{"):
+        envelope = json.loads(payload)
+        header = FrameHeader(
+            camera_id=str(envelope.get("camera") or DEFAULT_CAMERA),
+            burst_id=envelope.get("burst"),
+            seq=envelope.get("seq"),
+            count=int(envelope.get("count") or BURST_SIZE),
+        )
+        return header, envelope["image"]
+    return FrameHeader(DEFAULT_CAMERA, None, None, BURST_SIZE), payload
+
+
+class _Session:
+    def __init__(self, camera_id, burst_id, count, state):
+        self.camera_id = camera_id
+        self.burst_id = burst_id
+        self.count = count
+        self.state = state
+        self.items = {}  # seq -> item
+        self.last_seen = time.monotonic()
+
+    def burst(self, complete):
+        items = [self.items[seq] for seq in sorted(self.items)]
+        return Burst(self.camera_id, self.burst_id, items, complete, self.state)
+
+
+class BurstAssembler:
+    """
+    Groups frames into bursts keyed by (camera, burst id).
+
+    `on_burst(burst)` is called with every complete burst, and with
+    incomplete ones once they time out. `on_drop(burst)` is called for
+    bursts evicted because too many frames are buffered. `new_state(header)`,
+    if given, creates the per-burst state object carried along in Burst.state
+    from the FrameHeader of the burst's first frame.
+    """
+
+    def __init__(self, on_burst, on_drop=None, new_state=None, timeout=BURST_TIMEOUT, max_frames=BURST_MAX_FRAMES):
+        self.on_burst = on_burst
+        self.on_drop = on_drop
+        self.new_state = new_state
+        self.timeout = timeout
+        self.max_frames = max_frames
+        self.dropped = 0
+        self.timed_out = 0
+        self._sessions = OrderedDict()  # oldest first
+        self._frames = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flusher = None
+
+    def _session(self, header):
+        key = (header.camera_id, header.burst_id)
+        session = self._sessions.get(key)
+        if session is None:
+            state = self.new_state(header) if self.new_state else None
+            session = self._sessions[key] = _Session(header.camera_id, header.burst_id, header.count, state)
+        return key, session
+
+    def open(self, header):
+        """
+        Opens the burst of `header` if needed and returns its state.
+        """
+        with self._lock:
+            return self._session(header)[1].state
+
+    def add(self, header, item):
+        """
+        Adds one frame (an arbitrary `item`) to its burst.
+        """
+        ready, dropped = [], []
+        with self._lock:
+            self._start_flusher()
+            key, session = self._session(header)
+            seq = header.seq if header.seq is not None else len(session.items)
+            if seq not in session.items:
+                self._frames += 1
+            session.items[seq] = item
+            session.count = min(session.count, header.count)
+            session.last_seen = time.monotonic()
+            if len(session.items) >= session.count:
+                ready.append(self._pop(key).burst(complete=True))
+            while self._frames > self.max_frames and self._sessions:
+                dropped.append(self._pop(next(iter(self._sessions))).burst(complete=False))
+                self.dropped += 1
+        for burst in dropped:
+            print(f"Burst buffer full, dropping burst {burst.burst_id} from camera {burst.camera_id}")
+            if self.on_drop:
+                self._emit(self.on_drop, burst)
+        for burst in ready:
+            self._emit(self.on_burst, burst)
+
+    @staticmethod
+    def _emit(callback, burst):
+        try:
+            callback(burst)
+        except Exception as e:
+            print("Error handling burst:", e)
+
+    def _pop(self, key):
+        session = self._sessions.pop(key)
+        self._frames -= len(session.items)
+        return session
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="burst-flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait(self.timeout / 2)
+                now = time.monotonic()
+                expired = [key for key, s in self._sessions.items() if now - s.last_seen >= self.timeout]
+                bursts = [self._pop(key).burst(complete=False) for key in expired]
+                self.timed_out += len(bursts)
+            for burst in bursts:
+                print(f"Burst {burst.burst_id} from camera {burst.camera_id} timed out "
+                      f"with {len(burst.items)} frame(s)")
+                self._emit(self.on_burst, burst)
+
+    def status(self):
+        with self._lock:
+            return {
+                "open_bursts": len(self._sessions),
+                "buffered_frames": self._frames,
+                "dropped_bursts": self.dropped,
+                "timed_out_bursts": self.timed_out,
+            }
@@ -0,0 +1,143 @@
+import os
+import json
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from frame_assembler import FrameHeader, DEFAULT_CAMERA, BURST_SIZE
+
+###############################################################################
+# Chunked picture transport
+###############################################################################
+# Over a local MQTT broker the camera sends raw JPEG bytes instead of base64
+# JSON through Adafruit IO. Each frame is announced on the size topic by a
+# JSON header
+#     {"frame": "<hex id>", "camera": "door-1", "burst": "<id>", "seq": 0,
+#      "count": 2, "size": 48213, "chunks": 12, "crc32": 123456789}
+# and its bytes follow on the chunks topic, each chunk prefixed by the 16 byte
+# frame id and its big-endian uint32 index. Chunks may arrive before their
+# header; a frame is only released once its size and CRC check out.
+CHUNK_PREFIX = struct.Struct("!16sI")
+CHUNK_TIMEOUT = float(os.getenv("FRAME_CHUNK_TIMEOUT", "5"))  # seconds without a chunk before a frame is dropped
+MAX_PENDING_FRAMES = 32
+MAX_FRAME_BYTES = 4 * 1024 * 1024
+
+
+class _PendingFrame:
+    def __init__(self):
+        self.header = None
+        self.chunks = {}  # index -> bytes
+        self.received = 0
+        self.last_seen = time.monotonic()
+
+
+class ChunkReassembler:
+    """
+    Rebuilds frames from their header and chunks and calls
+    `on_frame(frame_assembler.FrameHeader, JPEG bytes)` with every intact one.
+    """
+
+    def __init__(self, on_frame, timeout=CHUNK_TIMEOUT, max_pending=MAX_PENDING_FRAMES, max_bytes=MAX_FRAME_BYTES):
+        self.on_frame = on_frame
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.completed = 0
+        self.corrupt = 0
+        self.timed_out = 0
+        self._pending = OrderedDict()  # frame id -> _PendingFrame, oldest first
+        self._lock = threading.Lock()
+
+    def _frame(self, frame_id):
+        # Called with the lock held
+        frame = self._pending.get(frame_id)
+        if frame is None:
+            self._expire()
+            frame = self._pending[frame_id] = _PendingFrame()
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.timed_out += 1
+        frame.last_seen = time.monotonic()
+        return frame
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [key for key, frame in self._pending.items() if now - frame.last_seen >= self.timeout]
+        for key in expired:
+            del self._pending[key]
+        if expired:
+            print(f"Dropped {len(expired)} incomplete chunked frame(s)")
+        self.timed_out += len(expired)
+
+    def add_header(self, payload):
+        try:
+            header = json.loads(payload)
+            frame_id = bytes.fromhex(header["frame"])
+            size, chunks = int(header["size"]), int(header["chunks"])
+        except (ValueError, KeyError, TypeError) as e:
+            print("Error parsing frame header:", e)
+            return
+        if not 0 < size <= self.max_bytes:
+            print(f"Frame of {size} bytes rejected")
+            return
+        with self._lock:
+            frame = self._frame(frame_id)
+            frame.header = dict(header, size=size, chunks=chunks)
+            ready = self._pop_complete(frame_id, frame)
+        self._emit(ready)
+
+    def add_chunk(self, payload):
+        if len(payload) <= CHUNK_PREFIX.size:
+            print("Error: chunk without data")
+            return
+        frame_id, index = CHUNK_PREFIX.unpack_from(payload)
+        data = bytes(payload[CHUNK_PREFIX.size:])
+        with self._lock:
+            frame = self._frame(frame_id)
+            if index not in frame.chunks:
+                frame.received += len(data)
+            frame.chunks[index] = data
+            if frame.received > self.max_bytes:
+                del self._pending[frame_id]
+                self.corrupt += 1
+                print("Chunked frame over the size limit, dropped")
+                return
+            ready = self._pop_complete(frame_id, frame)
+        self._emit(ready)
+
+    def _pop_complete(self, frame_id, frame):
+        # Called with the lock held; returns (header, data), or None while chunks are missing
+        header = frame.header
+        if header is None or len(frame.chunks) < header["chunks"]:
+            return None
+        del self._pending[frame_id]
+        data = b"".join(frame.chunks.get(i, b"") for i in range(header["chunks"]))
+        if len(data) != header["size"] or ("crc32" in header and zlib.crc32(data) != header["crc32"]):
+            self.corrupt += 1
+            print(f"Chunked frame {frame_id.hex()} failed its integrity check, dropped")
+            return None
+        self.completed += 1
+        return FrameHeader(
+            camera_id=str(header.get("camera") or DEFAULT_CAMERA),
+            burst_id=header.get("burst"),
+            seq=header.get("seq"),
+            count=int(header.get("count") or BURST_SIZE),
+        ), data
+
+    def _emit(self, ready):
+        if ready is None:
+            return
+        try:
+            self.on_frame(*ready)
+        except Exception as e:
+            print("Error handling chunked frame:", e)
+
+    def status(self):
+        with self._lock:
+            return {
+                "pending_frames": len(self._pending),
+                "completed_frames": self.completed,
+                "corrupt_frames": self.corrupt,
+                "timed_out_frames": self.timed_out,
+            }
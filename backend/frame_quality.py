@@ -0,0 +1,70 @@
+import os
+from collections import namedtuple
+import cv2
+import numpy as np
+
+###############################################################################
+# Frame quality gate
+###############################################################################
+# Cheap checks run on every frame before the expensive embedding. First the
+# image itself: sharpness (variance of the Laplacian) and mean brightness.
+# Then the faces from the frame's single detection pass: how many, and how
+# large. Failing frames are rejected with a reason; passing frames get a
+# score in (0, 1] used to weight them in the burst decision.
+QUALITY_GATE = os.getenv("QUALITY_GATE", "1") == "1"
+MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", "60"))  # 0 disables the blur check
+MIN_BRIGHTNESS = float(os.getenv("QUALITY_MIN_BRIGHTNESS", "40"))
+MAX_BRIGHTNESS = float(os.getenv("QUALITY_MAX_BRIGHTNESS", "220"))
+MIN_FACE_SIZE = int(os.getenv("QUALITY_MIN_FACE_SIZE", "60"))  # pixels, in the original frame
+# Frames are analysed at this width at most
+ANALYSIS_WIDTH = 320
+
+Quality = namedtuple("Quality", ["ok", "reason", "score", "sharpness", "brightness", "faces", "face_size"])
+
+
+def assess_image(image):
+    """
+    Rates a BGR frame before face detection. Returns a Quality whose `ok` is
+    False (with a `reason`) when the frame is not worth processing.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    scale = min(1.0, ANALYSIS_WIDTH / gray.shape[1])
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Downscaling sharpens, so blur is always measured at the analysis width
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    brightness = float(gray.mean())
+
+    reason = None
+    if brightness < MIN_BRIGHTNESS:
+        reason = f"too dark (brightness {brightness:.0f})"
+    elif brightness > MAX_BRIGHTNESS:
+        reason = f"overexposed (brightness {brightness:.0f})"
+    elif sharpness < MIN_SHARPNESS:
+        reason = f"blurred (sharpness {sharpness:.0f})"
+    # Sharper frames score higher; without a blur check every passing frame scores 1
+    if reason is not None:
+        score = 0.0
+    elif MIN_SHARPNESS <= 0:
+        score = 1.0
+    else:
+        score = float(np.clip(sharpness / (2 * MIN_SHARPNESS), 0.1, 1.0))
+    return Quality(reason is None, reason, score, sharpness, brightness, None, None)
+
+
+def assess_faces(quality, faces):
+    """
+    Completes an assess_image() Quality with the detected faces
+    (face_embedding.Face list).
+    """
+    sizes = [min(f.area["w"], f.area["h"]) for f in faces]
+    large = [size for size in sizes if size >= MIN_FACE_SIZE]
+    reason, score = quality.reason, quality.score
+    if reason is None and not large:
+        reason = "no face of sufficient size" if faces else "no face detected"
+        score = 0.0
+    elif reason is None:
+        # Several faces make the match ambiguous
+        score /= len(large)
+    return quality._replace(ok=reason is None, reason=reason, score=score,
+                            faces=len(faces), face_size=max(sizes, default=0))
@@ -0,0 +1,33 @@
+"""Add face_embedding table for precomputed face embeddings
+
+Revision ID: 3b1d7c9e2a41
+Revises: REPLACE_WITH_THIS_REV
+Create Date: 2026-10-17 09:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1d7c9e2a41'
+down_revision = 'REPLACE_WITH_THIS_REV'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'face_embedding',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('face_identity_id', sa.Integer(), sa.ForeignKey('face_identity.id'), nullable=False),
+        sa.Column('model_name', sa.String(length=50), nullable=False),
+        sa.Column('model_version', sa.String(length=50), nullable=True),
+        sa.Column('embedding', sa.LargeBinary(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.UniqueConstraint('face_identity_id', 'model_name', name='uix_face_model'),
+    )
+
+
+def downgrade():
+    op.drop_table('face_embedding')
@@ -0,0 +1,26 @@
+"""Add dtype to face_embedding for compact embedding blobs
+
+Revision ID: 8e4a1f2b6c73
+Revises: 3b1d7c9e2a41
+Create Date: 2026-10-17 14:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4a1f2b6c73'
+down_revision = '3b1d7c9e2a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('face_embedding') as batch_op:
+        batch_op.add_column(sa.Column('dtype', sa.String(length=10), nullable=False, server_default='float32'))
+
+
+def downgrade():
+    with op.batch_alter_table('face_embedding') as batch_op:
+        batch_op.drop_column('dtype')
@@ -0,0 +1,26 @@
+"""Add aligned flag to face_identity for batch-enrolled face crops
+
+Revision ID: c5d2e8a17f90
+Revises: 8e4a1f2b6c73
+Create Date: 2026-10-17 16:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d2e8a17f90'
+down_revision = '8e4a1f2b6c73'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('face_identity') as batch_op:
+        batch_op.add_column(sa.Column('aligned', sa.Boolean(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('face_identity') as batch_op:
+        batch_op.drop_column('aligned')
@@ -0,0 +1,37 @@
+"""Add place_access table and door camera mapping for access-scoped galleries
+
+Revision ID: d7f3b9c41e28
+Revises: c5d2e8a17f90
+Create Date: 2026-10-17 18:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f3b9c41e28'
+down_revision = 'c5d2e8a17f90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'place_access',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('place_id', sa.Integer(), sa.ForeignKey('places.id'), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.UniqueConstraint('user_id', 'place_id', name='uix_user_place'),
+    )
+    with op.batch_alter_table('door') as batch_op:
+        batch_op.add_column(sa.Column('camera_id', sa.String(length=80), nullable=True))
+        batch_op.create_unique_constraint('uq_door_camera_id', ['camera_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('door') as batch_op:
+        batch_op.drop_constraint('uq_door_camera_id', type_='unique')
+        batch_op.drop_column('camera_id')
+    op.drop_table('place_access')
@@ -0,0 +1,115 @@
+import sys
+import time
+from collections import defaultdict
+import face_embedding as fe
+from face_gallery import FaceGallery, FlatIndex
+from recognition import RecognitionEngine
+from benchmark_recognition import percentiles
+
+###############################################################################
+# Recognition profile comparison
+###############################################################################
+# Runs each profile over the enrolled faces. The first face of every user is
+# embedded to build that profile's gallery, then:
+#  - genuine probes, the user's other face images (held out of the gallery,
+#    as a new photo at the door would be), must match their own user;
+#  - impostor probes, every image matched with its own user left out of the
+#    candidates, must be rejected.
+# Users with a single face image only contribute impostor probes.
+
+
+def profile_report(faces, profile):
+    """
+    Returns the latency and accuracy of `profile` (a face_embedding.Profile)
+    on `faces`, a list of (face_identity_id, user_id, name, image bytes,
+    aligned); aligned face crops are embedded without detection.
+    """
+    engine = RecognitionEngine(profile)
+    start = time.perf_counter()
+    engine.load()
+    warmup = time.perf_counter() - start
+    timings = defaultdict(list)
+
+    def embed(img, aligned):
+        crop = img
+        if not aligned:
+            start = time.perf_counter()
+            detected = engine.detect(img)
+            timings["detect"].append(time.perf_counter() - start)
+            if not detected:
+                return None
+            crop = fe.largest_face(detected).crop
+        start = time.perf_counter()
+        embedding = engine.embed_face(crop)
+        timings["embed"].append(time.perf_counter() - start)
+        return embedding
+
+    rows, probes, no_face = [], [], 0
+    enrolled_users = set()
+    for face_identity_id, user_id, name, image_data, aligned in faces:
+        img = fe.decode_image(image_data)
+        start = time.perf_counter()
+        embedding = embed(img, aligned) if img is not None else None
+        if embedding is None:
+            no_face += 1
+            continue
+        held_out = user_id in enrolled_users
+        if not held_out:
+            enrolled_users.add(user_id)
+            rows.append((face_identity_id, user_id, name, embedding))
+        probes.append((user_id, embedding, held_out, time.perf_counter() - start))
+    gallery = FaceGallery(lambda: rows, index=FlatIndex(), model_name=profile.model_name, threshold=profile.threshold)
+
+    genuine, true_accepts = 0, 0
+    for user_id, embedding, held_out, embed_seconds in probes:
+        if not held_out:
+            continue
+        genuine += 1
+        start = time.perf_counter()
+        match = gallery.match(embedding)
+        timings["match"].append(time.perf_counter() - start)
+        timings["total"].append(embed_seconds + timings["match"][-1])
+        if match and match.verified and match.user_id == user_id:
+            true_accepts += 1
+
+    false_accepts = 0
+    for user_id, embedding, _, _ in probes:
+        distances, floor = gallery.user_distances(embedding)
+        distances.pop(user_id, None)
+        match = gallery.best_match(distances, floor)
+        if match and match.verified:
+            false_accepts += 1
+
+    return {
+        "profile": profile.name,
+        "model": profile.model_name,
+        "detector": profile.detector_backend,
+        "input_width": profile.input_width,
+        "threshold": gallery.threshold,
+        "warmup_seconds": round(warmup, 3),
+        "faces": len(faces),
+        "no_face": no_face,
+        "latency_ms": {stage: percentiles(seconds) for stage, seconds in timings.items()},
+        "enrolled": len(rows),
+        "genuine": genuine,
+        "impostors": len(probes),
+        "tar": round(true_accepts / genuine, 4) if genuine else None,
+        "far": round(false_accepts / len(probes), 4) if probes else None,
+    }
+
+
+def compare_profiles(faces, names=None):
+    """
+    Runs profile_report() for the named profiles (default: all of them).
+    A profile that fails to load is reported with its error.
+    """
+    results = []
+    for name in names or fe.PROFILES:
+        profile = fe.PROFILES[name]
+        print(f"Evaluating profile {name} ({profile.model_name}, {profile.detector_backend})", file=sys.stderr)
+        try:
+            results.append(profile_report(faces, profile))
+        except Exception as e:
+            print(f"Error evaluating profile {name}:", e)
+            results.append({"profile": name, "model": profile.model_name, "error": str(e)})
+    return results
@@ -0,0 +1,340 @@
+import os
+import threading
+import time
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+import numpy as np
+from deepface import DeepFace
+import face_embedding as fe
+import frame_quality as fq
+
+###############################################################################
+# Recognition engine
+###############################################################################
+# DeepFace builds the recognition model and the face detector lazily on first
+# use, which made the first door event after startup take several seconds.
+# The engine builds both once per process and runs a warm-up inference, so
+# every later frame reuses the same, already initialised instances.
+WARMUP_IMAGE_SIZE = (160, 160, 3)
+
+
+class RecognitionEngine:
+    def __init__(self, profile=fe.PROFILE):
+        self.profile = profile
+        self.model_name = profile.model_name
+        self.detector_backend = profile.detector_backend
+        self.model = None
+        self.warmup_seconds = None
+        self.error = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def load(self):
+        """
+        Builds the model and detector and runs one warm-up inference.
+        Safe to call from several threads; only the first call does the work.
+        """
+        with self._lock:
+            if self._ready.is_set():
+                return
+            start = time.time()
+            try:
+                self.model = DeepFace.build_model(self.model_name)
+                # A blank frame has no face, but running the detector and the
+                # model on it initialises both.
+                blank = np.zeros(WARMUP_IMAGE_SIZE, np.uint8)
+                fe.detect_faces(blank, detector_backend=self.detector_backend)
+                fe.embed_face(blank, self.model_name)
+            except Exception as e:
+                self.error = str(e)
+                print("Error loading recognition model:", e)
+                raise
+            self.warmup_seconds = time.time() - start
+            self.error = None
+            self._ready.set()
+            print(f"Recognition model {self.model_name} ready in {self.warmup_seconds:.1f}s")
+
+    def start(self):
+        """
+        Loads the engine in a background thread.
+        """
+        threading.Thread(target=self._load_quietly, name="recognition-warmup", daemon=True).start()
+
+    def _load_quietly(self):
+        try:
+            self.load()
+        except Exception:
+            pass
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def embed(self, img, enforce_detection=True):
+        """
+        Embeds the largest face of `img`, loading the engine first if needed.
+        """
+        self.load()
+        return fe.compute_embedding(img, enforce_detection=enforce_detection, profile=self.profile)
+
+    def detect(self, img):
+        self.load()
+        return fe.detect_faces(img, detector_backend=self.detector_backend, max_width=self.profile.input_width)
+
+    def embed_face(self, crop):
+        self.load()
+        return fe.embed_face(crop, self.model_name)
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "profile": self.profile.name,
+            "model": self.model_name,
+            "detector": self.detector_backend,
+            "input_width": self.profile.input_width,
+            "warmup_seconds": round(self.warmup_seconds, 3) if self.warmup_seconds is not None else None,
+            "error": self.error,
+        }
+
+
+# Process-wide instance
+engine = RecognitionEngine()
+
+
+###############################################################################
+# Recognition workers
+###############################################################################
+# Door frames are embedded in a worker pool so the MQTT callback only has to
+# enqueue them. Worker processes are forked (POSIX only) and each builds its
+# own engine in the initializer; elsewhere, or with
+# RECOGNITION_EXECUTOR=thread, a thread pool sharing `engine` is used.
+# Every worker process holds a full model, so only a couple are started, and
+# TensorFlow's thread pools are sized so that the workers together use about
+# one thread per core instead of one per core each.
+RECOGNITION_EXECUTOR = os.getenv("RECOGNITION_EXECUTOR", "process")  # "process" or "thread"
+RECOGNITION_WORKERS = int(os.getenv("RECOGNITION_WORKERS", min(2, os.cpu_count() or 1)))
+# TensorFlow intra-op threads per worker (inter-op: 1)
+RECOGNITION_THREADS = int(os.getenv("RECOGNITION_THREADS", max(1, (os.cpu_count() or 1) // RECOGNITION_WORKERS)))
+# Frames waiting or being processed; further frames are dropped
+RECOGNITION_QUEUE_SIZE = int(os.getenv("RECOGNITION_QUEUE_SIZE", "8"))
+
+
+_tf_threads = None  # intra-op threads set in this process
+
+
+def limit_tf_threads(threads=RECOGNITION_THREADS):
+    """
+    Caps TensorFlow's thread pools; only effective before the process runs
+    its first TensorFlow operation.
+    """
+    global _tf_threads
+    if _tf_threads == threads:
+        return
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+        _tf_threads = threads
+    except ImportError:
+        pass
+    except RuntimeError as e:
+        print("Could not limit TensorFlow threads:", e)
+
+
+def _init_worker():
+    limit_tf_threads()
+    engine.load()
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+# Result of one worker job; `timings` holds the seconds spent per stage
+FrameResult = namedtuple("FrameResult", ["embedding", "score", "face_jpeg", "timings"])
+
+
+def embed_frame(image_data):
+    """
+    Worker job: decodes one JPEG frame in memory, checks its quality, detects
+    and aligns its faces once and embeds the largest one.
+    Returns a FrameResult whose embedding is None when the frame was rejected,
+    and whose face_jpeg is the aligned face crop.
+    """
+    timings = {}
+    clock = [time.perf_counter()]
+
+    def lap(stage):
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0.0) + now - clock[0]
+        clock[0] = now
+
+    try:
+        image = fe.decode_image(image_data)
+        lap("decode")
+        if image is None:
+            raise ValueError("Undecodable image")
+        quality = fq.assess_image(image) if fq.QUALITY_GATE else None
+        lap("quality")
+        if quality and not quality.ok:
+            print(f"Rejected frame: {quality.reason}")
+            return FrameResult(None, 0.0, None, timings)
+        faces = engine.detect(image)
+        lap("detect")
+        if quality:
+            quality = fq.assess_faces(quality, faces)
+            lap("quality")
+            if not quality.ok:
+                print(f"Rejected frame: {quality.reason}")
+                return FrameResult(None, 0.0, None, timings)
+        elif not faces:
+            raise ValueError("Face could not be detected")
+        # The aligned crop is reused for the embedding and the unknown-person snapshot
+        crop = fe.largest_face(faces).crop
+        embedding = engine.embed_face(crop)
+        lap("embed")
+        face_jpeg = fe.encode_jpeg(crop)
+        lap("encode")
+        return FrameResult(embedding, quality.score if quality else 1.0, face_jpeg, timings)
+    except Exception as e:
+        print("Error in verification:", e)
+        return FrameResult(None, 0.0, None, timings)
+
+
+###############################################################################
+# Enrollment samples
+###############################################################################
+# Only a normalised face crop is kept per enrollment image: aligned, scaled
+# to ENROLL_CROP_SIZE square and JPEG encoded. The embedding is computed from
+# that same crop, so re-embedding it later (detection skipped) is consistent.
+ENROLL_CROP_SIZE = int(os.getenv("ENROLL_CROP_SIZE", "160"))
+ENROLL_JPEG_QUALITY = 90
+
+
+def enrollment_sample(image_data):
+    """
+    Returns (crop JPEG, embedding) for the largest face of an enrollment
+    image, or raises ValueError with the reason the image was rejected.
+    """
+    image = fe.decode_image(image_data)
+    if image is None:
+        raise ValueError("undecodable image")
+    quality = fq.assess_image(image)
+    if quality.ok:
+        faces = engine.detect(image)
+        quality = fq.assess_faces(quality, faces)
+    if not quality.ok:
+        raise ValueError(quality.reason)
+    crop = cv2.resize(fe.largest_face(faces).crop, (ENROLL_CROP_SIZE, ENROLL_CROP_SIZE), interpolation=cv2.INTER_AREA)
+    crop_jpeg = fe.encode_jpeg(crop, ENROLL_JPEG_QUALITY)
+    # Embed the crop as stored, after JPEG compression
+    return crop_jpeg, engine.embed_face(fe.decode_image(crop_jpeg))
+
+
+def on_all_done(futures, callback):
+    """
+    Calls `callback()` once every future in `futures` has completed.
+    """
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def run_callback():
+        try:
+            callback()
+        except Exception as e:
+            print("Error handling recognition result:", e)
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            run_callback()
+
+    if not futures:
+        run_callback()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+class Recognizer:
+    """
+    Bounded executor for recognition jobs.
+    """
+
+    def __init__(self, workers=RECOGNITION_WORKERS, queue_size=RECOGNITION_QUEUE_SIZE, kind=RECOGNITION_EXECUTOR,
+                 initializer=_init_worker):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        if kind == "process" and "fork" not in multiprocessing.get_all_start_methods():
+            kind = "thread"
+        self.kind = kind
+        self.initializer = initializer
+        self.dropped = 0
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._warmup = []
+
+    def start(self):
+        """
+        Creates the pool and warms up every worker.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=self.initializer,
+                                                     mp_context=multiprocessing.get_context("fork"))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, initializer=self.initializer,
+                                                    thread_name_prefix="recognition")
+            self._warmup = [self._executor.submit(_worker_ready) for _ in range(self.workers)]
+
+    @property
+    def ready(self):
+        return bool(self._warmup) and all(f.done() and not f.exception() for f in self._warmup)
+
+    def submit(self, fn, *args):
+        """
+        Queues `fn(*args)` on the pool. Returns its future, or None when the
+        queue is full and the job was dropped.
+        """
+        self.start()
+        if not self._slots.acquire(blocking=False):
+            self.dropped += 1
+            print("Recognition queue full, dropping job")
+            return None
+        with self._lock:
+            self._in_flight += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def status(self):
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "ready": self.ready,
+            "in_flight": self._in_flight,
+            "queue_size": self.queue_size,
+            "dropped": self.dropped,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+recognizer = Recognizer()
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+import numpy as np
+from face_gallery import normalise
+
+###############################################################################
+# Short-lived recognition result cache
+###############################################################################
+# Someone lingering at the door makes the camera fire burst after burst. A
+# verified match is remembered per camera together with the probe embedding,
+# and a later probe at the same camera that is close to it within the window
+# is answered from the cache: the matcher is not run again and the door
+# publish / log writes are not repeated. Rejections are never cached, so a
+# user rejected once is matched again on the next burst.
+DEDUPE_WINDOW = float(os.getenv("RECOGNITION_DEDUPE_WINDOW", "30"))  # seconds, 0 disables the cache
+# Cosine distance between two probe embeddings considered the same person
+DEDUPE_DISTANCE = float(os.getenv("RECOGNITION_DEDUPE_DISTANCE", "0.15"))
+DEDUPE_MAX_ENTRIES = 16  # per camera
+
+
+class RecognitionCache:
+    def __init__(self, window=DEDUPE_WINDOW, max_distance=DEDUPE_DISTANCE, max_entries=DEDUPE_MAX_ENTRIES):
+        self.window = window
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self._entries = defaultdict(lambda: deque(maxlen=max_entries))  # camera -> (expires, embedding, value)
+        self._lock = threading.Lock()
+
+    def _purge(self, entries, now):
+        while entries and entries[0][0] <= now:
+            entries.popleft()
+
+    def lookup(self, camera_id, embedding):
+        """
+        Returns the cached value for a probe close to `embedding` seen at
+        `camera_id` within the window, or None.
+        """
+        if self.window <= 0 or embedding is None:
+            return None
+        probe = normalise(embedding)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries[camera_id]
+            self._purge(entries, now)
+            if entries:
+                similarities = np.stack([e[1] for e in entries]) @ probe
+                best = int(np.argmax(similarities))
+                if 1.0 - similarities[best] <= self.max_distance:
+                    self.hits += 1
+                    return entries[best][2]
+            self.misses += 1
+            return None
+
+    def store(self, camera_id, embedding, value):
+        if self.window <= 0 or embedding is None:
+            return
+        with self._lock:
+            self._entries[camera_id].append((time.monotonic() + self.window, normalise(embedding), value))
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            for entries in self._entries.values():
+                self._purge(entries, now)
+            lookups = self.hits + self.misses
+            return {
+                "window_seconds": self.window,
+                "entries": sum(len(e) for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
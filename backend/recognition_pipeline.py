@@ -0,0 +1,101 @@
+import time
+from frame_assembler import BurstAssembler
+from burst_decision import BurstDecision
+from recognition import embed_frame, on_all_done
+
+###############################################################################
+# Picture feed recognition pipeline
+###############################################################################
+# The path of a door frame from the picture feed to a burst decision, kept
+# free of MQTT and the database so the app and the offline benchmark run the
+# same code: frames are grouped into bursts, embedded by the recognizer's
+# workers and scored against the gallery as they complete.
+UNKNOWN_PERSON = "Unknown Person"
+
+
+class RecognitionPipeline:
+    """
+    `on_decision(camera_id, decision)` is called with the burst_decision.Decision
+    of every burst that is decided (not dropped or suppressed by the cache).
+    `embed(image_data)` is the worker job returning a recognition.FrameResult.
+    `on_frame(result, match_seconds)`, if given, sees every scored frame.
+    `gallery_for(camera_id)`, if given, returns the gallery a camera's bursts
+    are matched against instead of `gallery`.
+    """
+
+    def __init__(self, gallery, on_decision, recognizer, cache=None, embed=embed_frame, on_frame=None,
+                 gallery_for=None, **assembler_options):
+        self.gallery = gallery
+        self.gallery_for = gallery_for
+        self.on_decision = on_decision
+        self.recognizer = recognizer
+        self.cache = cache
+        self.embed = embed
+        self.on_frame = on_frame
+        self.assembler = BurstAssembler(self._process_burst, on_drop=self._drop_burst,
+                                        new_state=self._new_decision, **assembler_options)
+
+    def _new_decision(self, header):
+        gallery = self.gallery_for(header.camera_id) if self.gallery_for else self.gallery
+        return BurstDecision(gallery)
+
+    def submit(self, header, image_data):
+        """
+        Queues one frame (frame_assembler.FrameHeader, JPEG bytes). Only
+        enqueues: decoding and inference run in the recognition workers.
+        """
+        decision = self.assembler.open(header)
+        future = None
+        if not decision.decided:
+            future = self.recognizer.submit(self.embed, image_data)
+            if future is not None:
+                decision.track(future)
+                future.add_done_callback(lambda f: self._frame_embedded(header.camera_id, decision, f, image_data))
+        self.assembler.add(header, future)
+
+    def _frame_embedded(self, camera_id, decision, future, image_data):
+        if future.cancelled() or decision.decided:
+            return
+        result = future.result()
+        if self.cache is not None:
+            cached = self.cache.lookup(camera_id, result.embedding)
+            if cached is not None:
+                # Same person still at this door: already handled, skip matching, publish and logs
+                print(f"Repeat recognition of {cached} at camera {camera_id}, suppressed")
+                decision.abandon()
+                return
+        start = time.perf_counter()
+        # Keep the aligned face crop as the snapshot when one was found
+        early = decision.add_frame(result.embedding, result.face_jpeg or image_data, result.score)
+        if self.on_frame:
+            self.on_frame(result, time.perf_counter() - start)
+        if early is not None:
+            # Confident match: skip the frames still waiting for a worker
+            decision.cancel_pending()
+            self._decided(camera_id, early)
+
+    def _process_burst(self, burst):
+        """
+        Decides a complete or timed out burst once all its frames are
+        embedded, unless one frame already decided it.
+        """
+        futures = [f for f in burst.items if f is not None]
+        on_all_done(futures, lambda: self._decided(burst.camera_id, burst.state.finish()))
+
+    @staticmethod
+    def _drop_burst(burst):
+        burst.state.abandon()
+
+    def _decided(self, camera_id, decision):
+        if decision is None:
+            return
+        match = decision.match
+        if self.cache is not None and match and match.verified:
+            self.cache.store(camera_id, decision.embedding, match.name)
+        self.on_decision(camera_id, decision)
+
+    def status(self):
+        status = {"bursts": self.assembler.status()}
+        if self.cache is not None:
+            status["cache"] = self.cache.status()
+        return status
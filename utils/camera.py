@@ -4,24 +4,175 @@ import cv2
 from Adafruit_IO import MQTTClient  
 import paho.mqtt.client as mqtt
 import base64
+import json
 import os
+import uuid
+import threading
+import struct
+import zlib
+from collections import deque
 
 # Adafruit IO Credentials
 AIO_USERNAME = os.getenv("AIO_USERNAME") # Replace with your Adafruit IO username
 AIO_KEY = os.getenv("AIO_KEY") # Replace with your Adafruit IO key from .env file
 AIO_FEED_COMMAND = "project-242.on-off"
+CAMERA_ID = os.getenv("CAMERA_ID", "door-1")  # identifies this camera's bursts on the backend
+BURST_SIZE = int(os.getenv("BURST_SIZE", "2"))
+FRAME_INTERVAL = float(os.getenv("FRAME_INTERVAL", "0.3"))  # seconds between the frames of a burst
+TRIGGER_COOLDOWN = float(os.getenv("TRIGGER_COOLDOWN", "2"))  # seconds after a burst before the next trigger
 
-broker = "localhost"  
+# The capture device stays open between door events and is only released after
+# CAMERA_IDLE_TIMEOUT seconds without a trigger (0 releases it after every burst)
+CAMERA_INDEX = int(os.getenv("CAMERA_INDEX", "0"))
+CAMERA_IDLE_TIMEOUT = float(os.getenv("CAMERA_IDLE_TIMEOUT", "120"))
+CAMERA_BUFFER_SIZE = 4      # most recent frames kept by the grabber
+CAMERA_WARMUP_FRAMES = 5    # frames dropped after opening while auto-exposure settles
+CAMERA_READ_TIMEOUT = 5     # seconds to wait for a frame before giving up
+
+# Frames are downscaled to the width the backend detects faces at (640 for the
+# most accurate profile) and encoded at the best JPEG quality within the budget
+JPEG_MAX_BYTES = int(os.getenv("JPEG_MAX_BYTES", "102400"))
+JPEG_MAX_QUALITY = 90
+JPEG_MIN_QUALITY = 20
+DOWNSCALE_STEP = 0.75        # shrink factor when the lowest quality is still over budget
+CAPTURE_WIDTH = int(os.getenv("CAPTURE_WIDTH", "640"))
+CROP_TO_FACE = os.getenv("CROP_TO_FACE", "0") == "1"  # send only the largest face and its surroundings
+FACE_MARGIN = 0.5            # crop margin on each side, relative to the face size
+FACE_DETECT_WIDTH = 320      # frames are downscaled to this width for face detection
+
+# Edge face filter: only frames with a large enough face are sent, so empty
+# doorway frames cost neither bandwidth nor a backend recognition pass. Up to
+# FACE_FILTER_ATTEMPTS frames are captured to fill a burst; a burst left short
+# is flushed by the backend after its burst timeout.
+FACE_FILTER = os.getenv("FACE_FILTER", "0") == "1"
+FACE_FILTER_MIN_SIZE = int(os.getenv("FACE_FILTER_MIN_SIZE", "60"))  # face width in pixels, as sent
+FACE_FILTER_ATTEMPTS = int(os.getenv("FACE_FILTER_ATTEMPTS", str(3 * BURST_SIZE)))
+
+# FRAME_TRANSPORT=local sends raw JPEG chunks to a local MQTT broker instead of
+# base64 JSON through Adafruit IO, which stays the fallback while the broker is
+# unreachable. Each frame is a JSON header on topic_size followed by chunks on
+# topic_data prefixed with the 16 byte frame id and a uint32 index.
+FRAME_TRANSPORT = os.getenv("FRAME_TRANSPORT", "adafruit")  # "adafruit" or "local"
+broker = os.getenv("LOCAL_MQTT_BROKER", "localhost")
+broker_port = int(os.getenv("LOCAL_MQTT_PORT", "1883"))
 topic_size = "image/size"    
 topic_data = "image/chunks"  
-chunk_size = 4096
+chunk_size = int(os.getenv("CHUNK_SIZE", "4096"))
+
+mqtt_client  = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+if FRAME_TRANSPORT == "local":
+    mqtt_client.connect_async(broker, broker_port, 60)
+    mqtt_client.loop_start()  # connects and reconnects in the background
+
+
+class Camera:
+    """
+    Keeps the capture device open and a grabber thread reading it into a
+    small ring buffer, so a trigger gets a fresh, already exposed frame
+    without paying for opening the device. The device is released once no
+    burst asked for frames for `idle_timeout` seconds and reopened by the
+    next one.
+    """
+
+    def __init__(self, index=CAMERA_INDEX, idle_timeout=CAMERA_IDLE_TIMEOUT, buffer_size=CAMERA_BUFFER_SIZE):
+        self.index = index
+        self.idle_timeout = idle_timeout
+        self._frames = deque(maxlen=buffer_size)  # (frame number, capture time, frame)
+        self._count = 0
+        self._cond = threading.Condition()
+        self._grabber = None
+        self._released = None  # previous grabber, possibly still releasing the device
+        self._served = 0  # last frame number handed out, never sent twice
+        self._active = 0  # bursts reading frames
+        self._last_used = 0
+
+    def _start(self):
+        # Called with the lock held; a new grabber waits for the previous one to release the device
+        if self._grabber is None:
+            self._frames.clear()
+            self._grabber = threading.Thread(target=self._grab, args=(self._released,),
+                                             name="camera-grabber", daemon=True)
+            self._grabber.start()
+
+    def _idle(self):
+        return not self._active and time.monotonic() - self._last_used >= self.idle_timeout
+
+    def _grab(self, previous):
+        if previous is not None:
+            previous.join()
+        cap = cv2.VideoCapture(self.index)
+        warmup = CAMERA_WARMUP_FRAMES
+        if cap.isOpened():
+            print(f"Camera {self.index} opened.")
+        else:
+            print(f"Error: Unable to open camera {self.index}.")
+        while cap.isOpened():
+            with self._cond:
+                if self._idle():
+                    break
+            ret, frame = cap.read()
+            if not ret:
+                print("Error: Unable to capture image.")
+                break
+            if warmup:
+                warmup -= 1
+                continue
+            with self._cond:
+                self._count += 1
+                self._frames.append((self._count, time.monotonic(), frame))
+                self._cond.notify_all()
+        with self._cond:
+            self._grabber = None
+            self._released = threading.current_thread()
+            self._cond.notify_all()
+        cap.release()
+        print(f"Camera {self.index} released.")
+
+    def burst(self, count, interval=FRAME_INTERVAL, timeout=CAMERA_READ_TIMEOUT):
+        """
+        Yields `count` frames at least `interval` seconds apart, starting with
+        the freshest one in the buffer. Stops early if the camera fails.
+        """
+        with self._cond:
+            self._active += 1
+            self._start()
+            grabber = self._grabber
+        try:
+            not_before = 0
+            for _ in range(count):
+                with self._cond:
+                    deadline = time.monotonic() + timeout
+                    while True:
+                        fresh = [f for f in self._frames if f[0] > self._served and f[1] >= not_before]
+                        if fresh:
+                            break
+                        remaining = deadline - time.monotonic()
+                        if self._grabber is not grabber or remaining <= 0:
+                            print("Error: No frame from the camera.")
+                            return
+                        self._cond.wait(remaining)
+                    self._served, captured, frame = fresh[-1]
+                not_before = captured + interval
+                yield frame
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._last_used = time.monotonic()
 
-mqtt_client  = mqtt.Client()
-# mqtt_client.connect(broker, 1883, 60)
+    def close(self):
+        """
+        Releases the device now, unless a burst is reading from it.
+        """
+        with self._cond:
+            self._last_used = float("-inf")
+            grabber = self._grabber
+        if grabber is not None:
+            grabber.join()
 
 
-cam = None
-ButtonState = False 
+cam = Camera()
+trigger = threading.Event()  # set by an "on" command, the main loop sleeps on it
+triggered_at = None
 
 # Initialize MQTT Client
 aio_client  = MQTTClient(AIO_USERNAME, AIO_KEY)
@@ -36,13 +187,14 @@ def disconnected(client):
 
 
 def message(client, feed_id, payload):
-    global ButtonState
+    global triggered_at
     print(f"Received: {payload}")
 
     if payload.lower() == "off":
-        ButtonState = False
+        trigger.clear()
     else:
-        ButtonState = True
+        triggered_at = time.monotonic()
+        trigger.set()
 
 aio_client.on_connect = connected
 aio_client.on_message = message
@@ -52,62 +204,190 @@ aio_client.connect()
 aio_client.loop_background()  # Keep MQTT connection alive in the background
 
 
-def image_capture(image_path):
-    ret, frame = cam.read()
-    if not ret:
-        print("Error: Unable to capture image.")
-        return
+face_detector = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
 
-    # Encode to JPEG in memory at high quality
-    result, encimg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
-    if not result:
-        print("Error: Failed to encode image.")
-        return
 
-    # Check if image size exceeds 100 KB
-    if len(encimg) > 102400:
-        print("Image larger than 100 KB, compressing...")
+def largest_face(frame):
+    """
+    Returns the (x, y, w, h) box of the largest face in the frame, or None.
+    """
+    scale = min(1.0, FACE_DETECT_WIDTH / frame.shape[1])
+    small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    faces = face_detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
+    if len(faces) == 0:
+        return None
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+    return tuple(int(round(v / scale)) for v in (x, y, w, h))
+
+
+def crop_to_face(frame, face):
+    x, y, w, h = face
+    mx, my = int(w * FACE_MARGIN), int(h * FACE_MARGIN)
+    height, width = frame.shape[:2]
+    return frame[max(0, y - my):min(height, y + h + my), max(0, x - mx):min(width, x + w + mx)]
+
+
+def encode_jpeg(frame, quality):
+    result, encimg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return encimg.tobytes() if result else None
 
-        # Try reducing quality to compress
-        for quality in range(90, 10, -10):
-            result, encimg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
-            if len(encimg) <= 102400:
-                print(f"Compressed under 100 KB with quality={quality}")
-                break
-    else:
-        print("Image is under 100 KB, no compression needed.")
 
-    # Write final compressed image to disk
-    with open(image_path, 'wb') as f:
-        f.write(encimg.tobytes())
+def image_capture(frame, face=None):
+    """
+    Returns the frame as JPEG bytes within JPEG_MAX_BYTES, or None. The
+    highest fitting quality is binary searched, and the frame is shrunk
+    further if even the lowest quality is too large. `face` is the box from
+    largest_face() if it was already run.
+    """
+    if CROP_TO_FACE:
+        face = face or largest_face(frame)
+        if face is not None:
+            frame = crop_to_face(frame, face)
+    while True:
+        if frame.shape[1] > CAPTURE_WIDTH:
+            scale = CAPTURE_WIDTH / frame.shape[1]
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        data = encode_jpeg(frame, JPEG_MAX_QUALITY)
+        if data is None:
+            print("Error: Failed to encode image.")
+            return None
+        if len(data) <= JPEG_MAX_BYTES:
+            return data
+        best, low, high = None, JPEG_MIN_QUALITY, JPEG_MAX_QUALITY - 1
+        while low <= high:
+            quality = (low + high) // 2
+            encoded = encode_jpeg(frame, quality)
+            if encoded is not None and len(encoded) <= JPEG_MAX_BYTES:
+                best, low = encoded, quality + 1
+            else:
+                high = quality - 1
+        if best is not None:
+            return best
+        print(f"Image over {JPEG_MAX_BYTES} bytes at quality {JPEG_MIN_QUALITY}, downscaling...")
+        frame = cv2.resize(frame, None, fx=DOWNSCALE_STEP, fy=DOWNSCALE_STEP, interpolation=cv2.INTER_AREA)
 
-def sending_image(image_path):
+def sending_image_local(image_data, burst_id, seq, count):
+    """
+    Publishes the frame to the local broker in chunks. Returns False if
+    the broker is not reachable.
+    """
+    if not mqtt_client.is_connected():
+        return False
+    frame_id = uuid.uuid4()
+    chunks = (len(image_data) + chunk_size - 1) // chunk_size
+    header = json.dumps({
+        "frame": frame_id.hex,
+        "camera": CAMERA_ID,
+        "burst": burst_id,
+        "seq": seq,
+        "count": count,
+        "size": len(image_data),
+        "chunks": chunks,
+        "crc32": zlib.crc32(image_data),
+    })
+    messages = [(topic_size, header)]
+    for index in range(chunks):
+        chunk = image_data[index * chunk_size:(index + 1) * chunk_size]
+        messages.append((topic_data, frame_id.bytes + struct.pack("!I", index) + chunk))
+    for topic, payload in messages:
+        if mqtt_client.publish(topic, payload, qos=1).rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+    print(f"Frame {seq} of burst {burst_id} ({len(image_data)} bytes) sent to {broker} in {chunks} chunk(s)")
+    return True
+
+
+def sending_image(image_data, burst_id, seq, count=BURST_SIZE):
+    """
+    Sends frame `seq` of a burst; `count` is the number of frames in the
+    burst, as far as known when the frame is sent.
+    """
+    if FRAME_TRANSPORT == "local":
+        if sending_image_local(image_data, burst_id, seq, count):
+            return
+        print(f"Local MQTT broker {broker} unavailable, sending through Adafruit IO")
     try:
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
+        encoded_string = base64.b64encode(image_data).decode("utf-8")
 
+        # Tag the frame with its burst so the backend can group it
+        payload = json.dumps({
+            "camera": CAMERA_ID,
+            "burst": burst_id,
+            "seq": seq,
+            "count": count,
+            "image": encoded_string,
+        })
         # Publish to Adafruit IO (Assuming you have a feed for images)
-        aio_client.publish("picture", encoded_string)
-        print(f"{img_path} successfully sent to Adafruit IO!")
+        aio_client.publish("picture", payload)
+        print(f"Frame {seq} of burst {burst_id} ({len(image_data)} bytes) successfully sent to Adafruit IO!")
 
     except Exception as e:
         print("Error sending image:", e)
 
 
+def face_present(frame):
+    """
+    Returns (whether the frame passes the edge face filter, face box or None).
+    """
+    face = largest_face(frame)
+    if face is None:
+        return False, None
+    # Measure the face at the size the backend will see it
+    scale = 1.0 if CROP_TO_FACE else min(1.0, CAPTURE_WIDTH / frame.shape[1])
+    return face[2] * scale >= FACE_FILTER_MIN_SIZE, face
+
+
+def capture_burst(started):
+    """
+    Captures and sends one burst; `started` is when the trigger arrived.
+    Each frame is sent once the next one is encoded, so that the last frame
+    carries the real frame count when the face filter cut the burst short
+    and the backend does not wait for frames that never come.
+    """
+    burst_id = uuid.uuid4().hex
+    frame_counts = {"captured": 0, "sent": 0, "skipped": 0}  # this session only
+    first, held, sent = None, None, 0
+    for frame in cam.burst(FACE_FILTER_ATTEMPTS if FACE_FILTER else BURST_SIZE):
+        if first is None:
+            first = time.monotonic() - started
+        frame_counts["captured"] += 1
+        face = None
+        if FACE_FILTER:
+            present, face = face_present(frame)
+            if not present:
+                frame_counts["skipped"] += 1
+                continue
+        image_data = image_capture(frame, face)
+        if image_data is None:
+            continue
+        if held is not None:
+            sending_image(held, burst_id, sent)
+            sent += 1
+        held = image_data
+        if sent + 1 >= BURST_SIZE:
+            break
+    if held is not None:
+        sending_image(held, burst_id, sent, count=sent + 1)
+        sent += 1
+    frame_counts["sent"] = sent
+    if first is not None:
+        print(f"Trigger to capture: {first * 1000:.0f} ms, burst done in {(time.monotonic() - started) * 1000:.0f} ms")
+    if FACE_FILTER and not sent:
+        print("No face in front of the camera, nothing sent.")
+    print(f"Frames this session: captured {frame_counts['captured']}, sent {frame_counts['sent']}, "
+          f"skipped {frame_counts['skipped']}")
+
 
-while True:
-    if ButtonState:
-        cam = cv2.VideoCapture(0)
+try:
+    while True:
+        trigger.wait()
+        trigger.clear()
         print("Camera turned ON.")
-        for i in range(2):
-            img_path = f"imaget_{i}.jpg"
-            image_capture(img_path)
-            sending_image(img_path)
-            time.sleep(1)
-        cam.release()
-        cam = None
-        new_aio_client = MQTTClient(AIO_USERNAME, AIO_KEY)
-        new_aio_client.connect()
-        new_aio_client.publish(AIO_FEED_COMMAND, "off")
-        time.sleep(2)
+        capture_burst(triggered_at)
+        aio_client.publish(AIO_FEED_COMMAND, "off")
         print("Camera turned OFF.")
+        time.sleep(TRIGGER_COOLDOWN)
+finally:
+    cam.close()
+    aio_client.disconnect()
+    mqtt_client.loop_stop()